@@ -8,27 +8,74 @@ Beancount to Ledger converter
 
 __license__ = "GPL-2.0-or-later"
 
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import io
+import itertools
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
 from beancount import loader
+from beancount.core import data
 from beancount.core import display_context
 from beancount.core.data import filter_txns
 from importlib.metadata import version, PackageNotFoundError
 
-from .common import map_data
 from .ledger import LedgerPrinter
 from .hledger import HLedgerPrinter
+from .common import prepare_transaction
+from .stats import ConversionStats
+from .filters import filter_entries
 
 try:
     __version__ = version(__name__)
 except PackageNotFoundError:
     __version__ = "undistributed"
 
+# Number of characters buffered by convert_to() before writing to the stream
+CHUNK_SIZE = 64 * 1024
+
+# Number of entries rendered at a time by a worker process
+JOB_CHUNK_SIZE = 1000
+
+# Number of entries rendered into a single list of parts by convert_to()
+# when entries are rendered directly (see _direct())
+BATCH_SIZE = 256
+
+# Entries of the parallel conversion in progress, its printer and, if
+# entries are timed, the number of slowest entries to keep, inherited by
+# the worker processes forked for it (see _convert_parallel())
+_worker_entries = None
+_worker_printer = None
+_worker_slowest = None
+
+# Held by the parallel conversion using the globals above
+_worker_lock = threading.Lock()
 
-def convert(entries, output_format="ledger", dcontext=None, config={}):
+
+def _phase(stats, name):
     """
-    Convert beancount entries to ledger output
+    Return a context manager recording the time of phase name in stats,
+    doing nothing if stats is None
     """
 
-    if not dcontext:
+    if stats is None:
+        return contextlib.ExitStack()
+    return stats.phase(name)
+
+
+def build_dcontext(entries, stats=None):
+    """
+    Build the display context used to format amounts from the postings
+    of all transactions, recording the time taken in stats
+    """
+
+    with _phase(stats, "dcontext"):
         dcontext = display_context.DisplayContext()
         for entry in filter_txns(entries):
             for posting in entry.postings:
@@ -41,18 +88,572 @@ def convert(entries, output_format="ledger", dcontext=None, config={}):
                 ):
                     continue
                 dcontext.update(posting.units.number, posting.units.currency)
+    return dcontext
+
+
+def _direct(jobs, cache, stats):
+    """
+    Return whether entries can be rendered directly into a shared list
+    of parts by a single printer, without timing, cache or workers
+    """
+
+    return jobs == 1 and cache is None and stats is None
+
+
+def get_printer(output_format="ledger", dcontext=None, config={}, handlers=None):
+    """
+    Return the printer for output_format
+
+    handlers maps entry types to functions rendering them instead of
+    the printer (see LedgerPrinter.register()).
+    """
 
     if output_format == "hledger":
-        printer = HLedgerPrinter(dcontext=dcontext, config=config)
-    else:
-        printer = LedgerPrinter(dcontext=dcontext, config=config)
-    return "\n".join(map_data(printer(entry), config) for entry in entries)
+        return HLedgerPrinter(dcontext=dcontext, config=config, handlers=handlers)
+    return LedgerPrinter(dcontext=dcontext, config=config, handlers=handlers)
+
+
+def _render_entries(printer, entries, stats=None):
+    """
+    Render entries with printer, timing each of them if stats are given
+    """
+
+    if stats is None:
+        for entry in entries:
+            yield printer(entry)
+        return
+
+    substitutions = printer.mapper.substitutions
+    for entry in entries:
+        begin = time.perf_counter()
+        text = printer(entry)
+        stats.add_entry(entry, time.perf_counter() - begin)
+        yield text
+    stats.mappings += printer.mapper.substitutions - substitutions
+
+
+def _render_range(start, stop):
+    """
+    Render the entries from start to stop in a worker process, returning
+    their text and their stats if entries are timed
+    """
+
+    stats = None if _worker_slowest is None else ConversionStats(_worker_slowest)
+    entries = _worker_entries[start:stop]
+    return list(_render_entries(_worker_printer, entries, stats)), stats
+
+
+def _map_chunks(executor, jobs, function, count, stats):
+    """
+    Render chunks of count entries with function(start, stop) in
+    executor, yielding the text of the entries in their original order
+    and merging the stats of the chunks into stats
+    """
+
+    starts = iter(range(0, count, JOB_CHUNK_SIZE))
+    # Keep a bounded number of chunks in flight so the output of a slow
+    # consumer doesn't pile up in memory
+    pending = collections.deque()
+    while True:
+        for start in itertools.islice(starts, 2 * jobs - len(pending)):
+            stop = min(start + JOB_CHUNK_SIZE, count)
+            pending.append(executor.submit(function, start, stop))
+        if not pending:
+            break
+        texts, chunk_stats = pending.popleft().result()
+        if chunk_stats is not None:
+            stats.merge(chunk_stats)
+        yield from texts
+
+
+def _convert_parallel(
+    entries, output_format, dcontext, config, jobs, stats, handlers=None
+):
+    """
+    Render chunks of entries in a pool of jobs processes, yielding the
+    text of the entries in their original order
+
+    The worker processes are forked once the entries and the printer are
+    in module globals, so only the bounds of each chunk are sent to them.
+    If another thread runs a parallel conversion already, entries are
+    rendered in this process.
+    """
+
+    global _worker_entries, _worker_printer, _worker_slowest
+    if not _worker_lock.acquire(blocking=False):
+        printer = get_printer(output_format, dcontext, config, handlers)
+        yield from _render_entries(printer, entries, stats)
+        return
+    try:
+        _worker_entries = entries
+        _worker_printer = get_printer(output_format, dcontext, config, handlers)
+        _worker_slowest = None if stats is None else stats.slowest
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(jobs, context) as executor:
+            yield from _map_chunks(executor, jobs, _render_range, len(entries), stats)
+    finally:
+        _worker_entries = _worker_printer = _worker_slowest = None
+        _worker_lock.release()
+
+
+def _render_thread_chunk(printer, entries, slowest, start, stop):
+    """
+    Render the entries from start to stop in a thread with the printer
+    shared by all threads, returning their text and their stats if
+    entries are timed
+    """
+
+    entries = entries[start:stop]
+    if slowest is None:
+        return [printer(entry) for entry in entries], None
+    stats = ConversionStats(slowest)
+    return list(_render_entries(printer, entries, stats)), stats
+
+
+def _convert_threaded(
+    entries, output_format, dcontext, config, jobs, stats, handlers=None
+):
+    """
+    Render chunks of entries in a pool of jobs threads sharing one
+    printer, yielding the text of the entries in their original order
+    """
+
+    printer = get_printer(output_format, dcontext, config, handlers)
+    slowest = None if stats is None else stats.slowest
+    render = functools.partial(_render_thread_chunk, printer, entries, slowest)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        yield from _map_chunks(executor, jobs, render, len(entries), stats)
+
+
+def _free_threaded():
+    """
+    Return whether Python runs without the global interpreter lock, so
+    threads can render entries in parallel
+    """
+
+    gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return gil_enabled is not None and not gil_enabled()
+
+
+def _render(entries, output_format, dcontext, config, jobs, stats, handlers=None):
+    """
+    Render entries in jobs threads if Python is free-threaded or can't
+    fork worker processes, or else in jobs processes, if there are
+    enough of them
+    """
+
+    if jobs > 1 and len(entries) > JOB_CHUNK_SIZE:
+        forks = "fork" in multiprocessing.get_all_start_methods()
+        if _free_threaded() or not forks:
+            convert_parallel = _convert_threaded
+        else:
+            convert_parallel = _convert_parallel
+        yield from convert_parallel(
+            entries, output_format, dcontext, config, jobs, stats, handlers
+        )
+        return
+
+    printer = get_printer(output_format, dcontext, config, handlers)
+    yield from _render_entries(printer, entries, stats)
+
+
+def convert_iter(
+    entries,
+    output_format="ledger",
+    dcontext=None,
+    config={},
+    jobs=1,
+    cache=None,
+    stats=None,
+    handlers=None,
+):
+    """
+    Convert beancount entries to ledger output, yielding the text of
+    one entry at a time
+
+    If jobs is larger than 1, entries are rendered in that many
+    processes (all CPUs if jobs is 0 or None), or threads on
+    free-threaded builds of Python.  The output is the same.
+
+    If a RenderCache is given as cache, the text of entries which were
+    rendered before with the same output format, dcontext and config is
+    taken from the cache and only the other entries are rendered.
+
+    If ConversionStats are given as stats, the time taken to build the
+    display context and to render each entry is recorded in them.
+
+    handlers maps entry types to functions rendering them instead of
+    the printer (see get_printer()).  The cache isn't used with
+    handlers since their output can't be told apart.
+    """
+
+    dcontext = dcontext or build_dcontext(entries, stats)
+    if not jobs:
+        jobs = os.cpu_count() or 1
 
+    if cache is None or handlers:
+        yield from _render(
+            entries, output_format, dcontext, config, jobs, stats, handlers
+        )
+        return
 
-def convert_file(file, output_format="ledger", dcontext=None, config={}):
+    def render(misses):
+        return _render(misses, output_format, dcontext, config, jobs, stats)
+
+    yield from cache.render(entries, render, output_format, dcontext, config)
+    if stats:
+        stats.cache = cache.stats()
+
+
+class _ChunkWriter:
+    """
+    Write texts to a stream in chunks of about chunk_size characters,
+    separated by separator
+    """
+
+    def __init__(self, stream, encoding, chunk_size, stats, separator="\n"):
+        if encoding is None and isinstance(stream, (io.RawIOBase, io.BufferedIOBase)):
+            encoding = "utf-8"
+        self.stream = stream
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.stats = stats
+        self.separator = separator
+        self.written = 0
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text):
+        """
+        Add text to the output, writing it if the chunk is full
+        """
+
+        if self.written or self.buffer:
+            self.buffer.append(self.separator)
+            self.size += len(self.separator)
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered texts to the stream
+        """
+
+        if not self.buffer:
+            return
+        chunk = "".join(self.buffer)
+        if self.encoding:
+            chunk = chunk.encode(self.encoding)
+            if self.stats:
+                self.stats.bytes += len(chunk)
+        elif self.stats:
+            encoding = getattr(self.stream, "encoding", None) or "utf-8"
+            self.stats.bytes += len(chunk.encode(encoding))
+        self.stream.write(chunk)
+        self.written += self.size
+        self.buffer = []
+        self.size = 0
+
+
+def convert_to(
+    entries,
+    stream,
+    output_format="ledger",
+    dcontext=None,
+    config={},
+    encoding=None,
+    chunk_size=CHUNK_SIZE,
+    jobs=1,
+    cache=None,
+    stats=None,
+    price_stream=None,
+    handlers=None,
+):
+    """
+    Convert beancount entries to ledger output and write it to stream
+
+    The output is the same as the one returned by convert() but it's
+    written in chunks of about chunk_size characters as entries are
+    rendered.  Binary streams (or any stream if encoding is given) are
+    written encoded, by default as UTF-8.  Returns the number of
+    characters written.
+
+    If price_stream is given, prices are written to it instead of
+    stream, one per line, as a price database for ledger's --price-db
+    option.  Both outputs are written as entries are rendered.
+
+    See convert_iter() for the other arguments.
+    """
+
+    # Build the display context first so it's not counted as rendering
+    dcontext = dcontext or build_dcontext(entries, stats)
+    # Entries are separated by an empty line, like in convert()
+    out = _ChunkWriter(stream, encoding, chunk_size, stats)
+    if price_stream is None and _direct(jobs, cache, stats):
+        printer = get_printer(output_format, dcontext, config, handlers)
+        for start in range(0, len(entries), BATCH_SIZE):
+            out.write(printer.render_all(entries[start : start + BATCH_SIZE]))
+        out.flush()
+        return out.written
+
+    texts = convert_iter(
+        entries, output_format, dcontext, config, jobs, cache, stats, handlers
+    )
+    with _phase(stats, "render"):
+        if price_stream is None:
+            for text in texts:
+                out.write(text)
+            out.flush()
+            return out.written
+
+        prices = _ChunkWriter(price_stream, encoding, chunk_size, stats, "")
+        # Texts are yielded in the order of the entries
+        for entry, text in zip(entries, texts):
+            if isinstance(entry, data.Price):
+                prices.write(text)
+            else:
+                out.write(text)
+        out.flush()
+        prices.flush()
+    return out.written + prices.written
+
+
+class _SharedPreparation:
+    """
+    Prepare transactions for several printers rendering them in turn,
+    preparing each transaction only once
+    """
+
+    def __init__(self, dformat):
+        self.dformat = dformat
+        self.entry = None
+        self.prepared = None
+
+    def __call__(self, entry):
+        if entry is not self.entry:
+            self.entry = entry
+            self.prepared = prepare_transaction(entry, self.dformat)
+        return self.prepared
+
+
+def convert_to_many(
+    entries,
+    outputs,
+    dcontext=None,
+    config={},
+    encoding=None,
+    chunk_size=CHUNK_SIZE,
+    stats=None,
+):
+    """
+    Convert beancount entries to several output formats in a single
+    pass, writing each to its own stream
+
+    outputs is a sequence of (output_format, stream) pairs.  Each stream
+    gets the same output as with convert_to(), but the entries are
+    traversed once and the display context is built once for all
+    formats.  So is the preparation of transactions (see
+    prepare_transaction()).  Returns a list of the number of characters
+    written to each stream.
+    """
+
+    dcontext = dcontext or build_dcontext(entries, stats)
+    printers = [get_printer(fmt, dcontext, config) for fmt, _ in outputs]
+    writers = [
+        _ChunkWriter(stream, encoding, chunk_size, stats) for _, stream in outputs
+    ]
+    if printers:
+        # All printers format amounts with the same dcontext
+        prepare = _SharedPreparation(printers[0].dformat)
+        for printer in printers:
+            printer.prepare = prepare
+    renderers = list(zip(printers, writers))
+    with _phase(stats, "render"):
+        for entry in entries:
+            begin = time.perf_counter()
+            for printer, writer in renderers:
+                writer.write(printer(entry))
+            if stats:
+                stats.add_entry(entry, time.perf_counter() - begin)
+        for writer in writers:
+            writer.flush()
+    if stats:
+        stats.mappings += sum(printer.mapper.substitutions for printer in printers)
+    return [writer.written for writer in writers]
+
+
+def convert(
+    entries,
+    output_format="ledger",
+    dcontext=None,
+    config={},
+    jobs=1,
+    cache=None,
+    stats=None,
+    handlers=None,
+):
+    """
+    Convert beancount entries to ledger output
+
+    See convert_iter() for the arguments.
+    """
+
+    # Build the display context first so it's not counted as rendering
+    dcontext = dcontext or build_dcontext(entries, stats)
+    if _direct(jobs, cache, stats):
+        printer = get_printer(output_format, dcontext, config, handlers)
+        return printer.render_all(entries)
+
+    texts = convert_iter(
+        entries, output_format, dcontext, config, jobs, cache, stats, handlers
+    )
+    if stats is None:
+        return "\n".join(texts)
+
+    with _phase(stats, "render"):
+        parts = []
+        size = 0
+        for text in texts:
+            parts.append(text)
+            # Most texts are ASCII, whose length is their size in UTF-8
+            size += len(text) if text.isascii() else len(text.encode("utf-8"))
+        # Entries are separated by a newline
+        stats.bytes += size + max(len(parts) - 1, 0)
+        return "\n".join(parts)
+
+
+def load_file(file, stats=None):
+    """
+    Load a beancount file, recording the time taken in stats
+
+    Returns a tuple of the entries and the options map.
+    """
+
+    with _phase(stats, "load"):
+        entries, _, options_map = loader.load_file(file)
+    return entries, options_map
+
+
+def load_string(string, stats=None):
+    """
+    Load beancount entries from string, recording the time taken in stats
+
+    Files included by string are relative to the current directory.
+    Returns a tuple of the entries and the options map.
+    """
+
+    with _phase(stats, "load"):
+        entries, _, options_map = loader.load_string(string)
+    return entries, options_map
+
+
+def select_entries(
+    entries,
+    options_map=None,
+    begin=None,
+    end=None,
+    account=None,
+    opening=False,
+    stats=None,
+):
+    """
+    Select the entries from begin to end involving accounts matching
+    account, recording the time taken in stats
+
+    See filters.filter_entries() for details.
+    """
+
+    if begin is None and end is None and account is None:
+        return entries
+    with _phase(stats, "select"):
+        return filter_entries(entries, begin, end, account, opening, options_map)
+
+
+def convert_file(
+    file,
+    output_format="ledger",
+    dcontext=None,
+    config={},
+    jobs=1,
+    cache=None,
+    stats=None,
+    begin=None,
+    end=None,
+    account=None,
+    opening=False,
+):
     """
     Convert beancount file to ledger output
+
+    If begin, end or account are given, only the selected entries are
+    converted (see filters.filter_entries()).  They are formatted like
+    in the output of the whole file.
+    """
+
+    entries, options_map = load_file(file, stats)
+    dcontext = dcontext or build_dcontext(entries, stats)
+    entries = select_entries(entries, options_map, begin, end, account, opening, stats)
+    return convert(
+        entries,
+        output_format,
+        dcontext=dcontext,
+        config=config,
+        jobs=jobs,
+        cache=cache,
+        stats=stats,
+    )
+
+
+def convert_file_to(
+    file,
+    stream,
+    output_format="ledger",
+    dcontext=None,
+    config={},
+    encoding=None,
+    jobs=1,
+    cache=None,
+    stats=None,
+    begin=None,
+    end=None,
+    account=None,
+    opening=False,
+    price_stream=None,
+):
+    """
+    Convert beancount file to ledger output and write it to stream
+
+    Entries can be selected like in convert_file().  If price_stream is
+    given, prices are written to it (see convert_to()).
+    """
+
+    entries, options_map = load_file(file, stats)
+    dcontext = dcontext or build_dcontext(entries, stats)
+    entries = select_entries(entries, options_map, begin, end, account, opening, stats)
+    return convert_to(
+        entries,
+        stream,
+        output_format,
+        dcontext,
+        config,
+        encoding=encoding,
+        jobs=jobs,
+        cache=cache,
+        stats=stats,
+        price_stream=price_stream,
+    )
+
+
+def convert_file_stats(file, output_format="ledger", config={}, **kwargs):
+    """
+    Convert beancount file to ledger output, collecting stats
+
+    Returns a tuple of the output and the ConversionStats of the
+    conversion.  Other keyword arguments are passed to convert().
     """
 
-    entries, _, __ = loader.load_file(file)
-    return convert(entries, output_format, dcontext=dcontext, config=config)
+    stats = ConversionStats()
+    output = convert_file(file, output_format, config=config, stats=stats, **kwargs)
+    return output, stats
@@ -0,0 +1,332 @@
+"""
+Persistent cache of rendered entries
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import collections
+import datetime
+import hashlib
+import json
+import os
+from pathlib import Path
+import sqlite3
+import time
+
+from beancount.core.number import Decimal
+
+from . import __version__
+
+# Default maximum number of rendered entries kept in the cache
+MAX_ENTRIES = 1000000
+
+# Number of keys looked up or stored with a single query
+BATCH_SIZE = 500
+
+# Seconds before the cache was opened within which a change to a source
+# file may have happened after it was loaded, given the resolution of
+# file modification times
+MTIME_MARGIN = 2
+
+# Metadata keys which are part of the source text or not rendered
+IGNORED_META = ("filename", "lineno", "__tolerances__")
+
+
+def default_path():
+    """
+    Return the path of the default cache database
+    """
+
+    xdg = Path.expanduser(Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")))
+    return xdg / "beancount2ledger" / "cache.sqlite"
+
+
+def canonical(obj, lineno=None):
+    """
+    Return a string representation of obj which is stable across runs.
+
+    The filename and line number of an entry are left out, so moving an
+    entry around in a file doesn't change its representation.  The line
+    number of postings is kept relative to the line number of the
+    entry (lineno) since it decides the order of the postings.
+    """
+
+    if isinstance(obj, tuple) and hasattr(obj, "_fields"):
+        if lineno is None and isinstance(getattr(obj, "meta", None), dict):
+            lineno = obj.meta.get("lineno")
+        fields = ", ".join(
+            f"{field}={canonical(getattr(obj, field), lineno)}" for field in obj._fields
+        )
+        return f"{type(obj).__name__}({fields})"
+    if isinstance(obj, dict):
+        items = []
+        for key, val in obj.items():
+            if key == "filename":
+                continue
+            if key == "lineno":
+                if not isinstance(val, int) or lineno is None:
+                    continue
+                val -= lineno
+            items.append(f"{key!r}: {canonical(val, lineno)}")
+        return "{" + ", ".join(items) + "}"
+    if isinstance(obj, (list, tuple)):
+        return "[" + ", ".join(canonical(item, lineno) for item in obj) + "]"
+    if isinstance(obj, (set, frozenset)):
+        return "{" + ", ".join(sorted(canonical(item, lineno) for item in obj)) + "}"
+    if isinstance(obj, (Decimal, datetime.date)):
+        return f"{type(obj).__name__}({obj})"
+    return repr(obj)
+
+
+def derived(entry):
+    """
+    Return a representation of the parts of entry which don't come from
+    its source text alone: the ones the loader or plugins can fill in
+    from other entries or change, such as metadata set with pushmeta,
+    interpolated amounts and booked costs
+    """
+
+    meta = entry.meta
+    parts = [
+        [(key, meta[key]) for key in meta if key not in IGNORED_META],
+        getattr(entry, "payee", None),
+        getattr(entry, "narration", None),
+        getattr(entry, "amount", None),
+    ]
+    for name in ("tags", "links"):
+        values = getattr(entry, name, None)
+        if values:
+            parts.append(sorted(values))
+    for posting in getattr(entry, "postings", None) or ():
+        units = posting.units
+        parts.append(
+            (
+                posting.account,
+                units.number,
+                units.currency,
+                posting.cost,
+                posting.price,
+                posting.flag,
+                posting.meta
+                and [
+                    (key, posting.meta[key])
+                    for key in posting.meta
+                    if key not in IGNORED_META
+                ],
+            )
+        )
+    return repr(parts)
+
+
+class SourceKeys:
+    """
+    Keys of entries based on their source text.
+
+    Hashing all of an entry costs about as much as rendering it, while
+    reading its source text is cheaper.  The source text of an entry
+    runs from its line to the line of the next entry from the same
+    file.  The parts of the entry which can come from elsewhere are
+    added to the key (see derived()).
+
+    Entries without a source file, such as the ones added by plugins,
+    get no key.  So do entries from files modified after since (give or
+    take MTIME_MARGIN), which may have changed after they were loaded.
+    """
+
+    def __init__(self, since):
+        self.since = since - MTIME_MARGIN
+        self.sources = {}
+
+    def lines(self, filename):
+        """
+        Return the lines of filename, or None if they can't be used
+        """
+
+        if filename not in self.sources:
+            lines = None
+            if isinstance(filename, str) and os.path.isabs(filename):
+                try:
+                    with open(filename, encoding="utf-8") as stream:
+                        if os.fstat(stream.fileno()).st_mtime < self.since:
+                            lines = stream.read().split("\n")
+                except (OSError, UnicodeDecodeError):
+                    pass
+            self.sources[filename] = lines
+        return self.sources[filename]
+
+    def keys(self, context, entries):
+        """
+        Return the key of each of entries rendered in context, or None
+        for entries which can't be cached
+        """
+
+        starts = collections.defaultdict(set)
+        for entry in entries:
+            starts[entry.meta.get("filename")].add(entry.meta.get("lineno"))
+        ends = {}
+        for filename, linenos in starts.items():
+            linenos = sorted(n for n in linenos if isinstance(n, int))
+            ends[filename] = dict(zip(linenos, linenos[1:] + [None]))
+
+        seen = collections.Counter()
+        keys = []
+        for entry in entries:
+            filename = entry.meta.get("filename")
+            lineno = entry.meta.get("lineno")
+            lines = self.lines(filename)
+            if lines is None or lineno not in ends[filename]:
+                keys.append(None)
+                continue
+            end = ends[filename][lineno]
+            source = "\n".join(lines[lineno - 1 : end - 1 if end else None])
+            # Plugins can add entries with the line number of another
+            position = (filename, lineno, type(entry).__name__)
+            seen[position] += 1
+            text = (
+                f"{context}\n{position[2]} {seen[position]}\n{source}\n"
+                f"{derived(entry)}"
+            )
+            keys.append(hashlib.sha256(text.encode("utf-8")).hexdigest())
+        return keys
+
+
+class RenderCache:
+    """
+    Cache of rendered entries stored in an SQLite database.
+
+    Rendered text is keyed by a hash of the source of the entry (see
+    SourceKeys) and of everything else the output depends on: the output
+    format, the display context and the config.  The least recently used
+    entries are evicted when the cache grows beyond max_entries.
+    """
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES):
+        self.path = Path(path) if path else default_path()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.opened = time.time()
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, text TEXT NOT NULL, used INTEGER NOT NULL)"
+        )
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.used = []
+        self.new = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def context(output_format, dcontext, config):
+        """
+        Return a key for everything apart from the entry that the
+        rendered text depends on
+        """
+
+        config = json.dumps(config, sort_keys=True, default=str)
+        text = f"{__version__}\n{output_format}\n{dcontext}\n{config}"
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def lookup(self, keys):
+        """
+        Return a dict of the cached text of the keys which are in the
+        cache
+        """
+
+        found = {}
+        for i in range(0, len(keys), BATCH_SIZE):
+            batch = keys[i : i + BATCH_SIZE]
+            query = "SELECT key, text FROM entries WHERE key IN ({})".format(
+                ", ".join("?" * len(batch))
+            )
+            found.update(self.db.execute(query, batch))
+        self.used.extend(found)
+        return found
+
+    def put(self, key, text):
+        """
+        Store the text for key
+        """
+
+        self.new.append((key, text))
+        if len(self.new) >= BATCH_SIZE:
+            self.flush()
+
+    def render(self, entries, render, output_format, dcontext, config):
+        """
+        Yield the text of entries, taken from the cache or rendered by
+        calling render on the list of entries which are not cached
+        """
+
+        context = self.context(output_format, dcontext, config)
+        keys = SourceKeys(self.opened).keys(context, entries)
+        cached = self.lookup([key for key in keys if key])
+        misses = [entry for entry, key in zip(entries, keys) if key not in cached]
+        self.hits += len(entries) - len(misses)
+        self.misses += len(misses)
+        rendered = render(misses)
+        for key in keys:
+            if key in cached:
+                yield cached[key]
+            else:
+                text = next(rendered)
+                if key:
+                    self.put(key, text)
+                yield text
+
+    def flush(self):
+        """
+        Write new entries and usage times to the database
+        """
+
+        now = int(time.time() * 1e9)
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO entries (key, text, used) VALUES (?, ?, ?)",
+                ((key, text, now) for key, text in self.new),
+            )
+            self.db.executemany(
+                "UPDATE entries SET used = ? WHERE key = ?",
+                ((now, key) for key in self.used),
+            )
+        self.new = []
+        self.used = []
+
+    def evict(self):
+        """
+        Remove the least recently used entries beyond max_entries
+        """
+
+        with self.db:
+            cursor = self.db.execute(
+                "DELETE FROM entries WHERE key IN "
+                "(SELECT key FROM entries ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+        self.evicted += cursor.rowcount
+
+    def close(self):
+        """
+        Write pending changes, evict old entries and close the database
+        """
+
+        self.flush()
+        self.evict()
+        self.db.close()
+
+    def stats(self):
+        """
+        Return a dict of cache statistics
+        """
+
+        return {"hits": self.hits, "misses": self.misses, "evicted": self.evicted}
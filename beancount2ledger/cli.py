@@ -11,23 +11,32 @@ __license__ = "GPL-2.0-or-later"
 
 import argparse
 import contextlib
-import locale
 from pathlib import Path
 import os
 import sys
-from tempfile import NamedTemporaryFile
 import yaml
 
 import beancount2ledger
+from beancount2ledger.cache import RenderCache, MAX_ENTRIES
+from beancount2ledger.common import set_default, validate_config
+from beancount2ledger.stats import ConversionStats
+from beancount2ledger.profiling import profile
+from beancount2ledger import server
+from beancount2ledger import watch
+from beancount2ledger.tree import convert_tree
+from beancount2ledger.output import atomic_open
+from beancount2ledger.prices import convert_prices_to, price_entries
 
 
-def get_config(user_config):
+def read_config(user_config):
     """
-    Get config from config file
+    Read config from config file
+
+    Returns a tuple of the name of the config file and the config.
     """
 
     if user_config:
-        return yaml.safe_load(user_config)
+        return user_config.name, yaml.safe_load(user_config)
     all_config = []
     all_config.append(Path(".beancount2ledger.yaml"))
     xdg = Path.expanduser(Path(os.environ.get("XDG_CONFIG_HOME", "~/.config")))
@@ -35,8 +44,121 @@ def get_config(user_config):
     for config in all_config:
         if config.exists():
             with open(config, "r") as config_stream:
-                return yaml.safe_load(config_stream)
-    return {}
+                return str(config), yaml.safe_load(config_stream)
+    return None, {}
+
+
+def get_config(user_config):
+    """
+    Get config from config file, exiting with an error if it's invalid
+    """
+
+    name, config = read_config(user_config)
+    try:
+        # An empty file has no options
+        config = config or {}
+        validate_config(config)
+        return set_default(config)
+    except ValueError as e:
+        sys.exit(f"beancount2ledger: {name}: {e}")
+
+
+def default_format():
+    """
+    Return the default output format, depending on the program name
+    """
+
+    if "hledger" in sys.argv[0]:
+        return "hledger"
+    return "ledger"
+
+
+def serve_cli(argv):
+    """
+    Main function of the serve command
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="beancount2ledger serve",
+        description="Keep a beancount file loaded and answer conversion "
+        "requests on a Unix socket",
+    )
+    parser.add_argument("file", help="beancount file", type=str)
+    parser.add_argument(
+        "-s",
+        "--socket",
+        help=f"socket path (default: {server.default_socket_path()})",
+    )
+    parser.add_argument(
+        "-c", "--config", help="config file", type=argparse.FileType("r")
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=server.POLL_INTERVAL,
+        metavar="SECONDS",
+        help="interval between checks for changes to the file "
+        f"(default: {server.POLL_INTERVAL})",
+    )
+    args = parser.parse_args(argv)
+    try:
+        server.serve(args.file, args.socket, get_config(args.config), args.interval)
+    except RuntimeError as e:
+        sys.exit(f"beancount2ledger serve: {e}")
+
+
+def client_cli(argv):
+    """
+    Main function of the client command
+    """
+
+    default = default_format()
+    parser = argparse.ArgumentParser(
+        prog="beancount2ledger client",
+        description="Request a conversion from a beancount2ledger server",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=("ledger", "hledger"),
+        default=default,
+        help=f"output format (default: {default})",
+    )
+    parser.add_argument(
+        "-s",
+        "--socket",
+        help=f"socket path (default: {server.default_socket_path()})",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        type=argparse.FileType("r"),
+        help="config file overriding options of the server's config",
+    )
+    parser.add_argument("--begin", metavar="DATE", help="first date (YYYY-MM-DD)")
+    parser.add_argument("--end", metavar="DATE", help="end date, exclusive")
+    parser.add_argument(
+        "--account", metavar="REGEX", help="only entries involving matching accounts"
+    )
+    parser.add_argument(
+        "--opening-balances",
+        action="store_true",
+        help="summarize the entries before --begin as opening balances",
+    )
+    args = parser.parse_args(argv)
+
+    params = {"format": args.format}
+    if args.config:
+        params["config"] = yaml.safe_load(args.config) or {}
+    for key in ("begin", "end", "account"):
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    if args.opening_balances:
+        params["opening"] = True
+    try:
+        server.request(sys.stdout.buffer, args.socket, **params)
+    except (OSError, ValueError) as e:
+        sys.exit(f"beancount2ledger client: {e}")
 
 
 def cli():
@@ -44,25 +166,124 @@ def cli():
     Main function for CLI access.
     """
 
-    if "hledger" in sys.argv[0]:
-        default = "hledger"
-    else:
-        default = "ledger"
+    commands = {"serve": serve_cli, "client": client_cli}
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        commands[sys.argv[1]](sys.argv[2:])
+        return
+
+    default = default_format()
 
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
         "-f",
         "--format",
         dest="format",
-        action="store",
+        action="append",
         choices=("ledger", "hledger"),
-        default=default,
-        help=f"output format (default: {default})",
+        help=f"output format (default: {default}); can be given several times, "
+        "each with its own --output",
     )
     parser.add_argument("file", help="beancount file", type=str)
     parser.add_argument(
         "-c", "--config", help="config file", type=argparse.FileType("r")
     )
+    parser.add_argument(
+        "-o", "--output", metavar="FILE", action="append", help="output file"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="convert the file again whenever it or a file it includes changes "
+        "(requires --output)",
+    )
+    parser.add_argument(
+        "--tree",
+        metavar="DIR",
+        help="write one output file per source file to DIR, only rewriting "
+        "outputs whose entries changed",
+    )
+    parser.add_argument(
+        "--only",
+        choices=("prices",),
+        help="only convert prices, as a compact price database",
+    )
+    parser.add_argument(
+        "--dedupe-prices",
+        action="store_true",
+        help="with --only prices, skip prices with the same date, commodity "
+        "and amount as a previous price",
+    )
+    parser.add_argument(
+        "--price-db",
+        metavar="FILE",
+        help="write prices to FILE, a price database for ledger's --price-db "
+        "option, instead of the output",
+    )
+    parser.add_argument(
+        "--begin", metavar="DATE", help="only convert entries from DATE (YYYY-MM-DD)"
+    )
+    parser.add_argument(
+        "--end", metavar="DATE", help="only convert entries before DATE (YYYY-MM-DD)"
+    )
+    parser.add_argument(
+        "--account",
+        metavar="REGEX",
+        help="only convert entries involving accounts matching REGEX",
+    )
+    parser.add_argument(
+        "--opening-balances",
+        action="store_true",
+        help="summarize the entries before --begin as opening balances",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes used to render entries (0: one per CPU)",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="reuse entries rendered by previous runs",
+    )
+    parser.add_argument(
+        "--cache-file",
+        metavar="FILE",
+        help="store the cache in FILE (implies --cache; default: "
+        "$XDG_CACHE_HOME/beancount2ledger/cache.sqlite)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=MAX_ENTRIES,
+        metavar="N",
+        help=f"maximum number of entries in the cache (default: {MAX_ENTRIES})",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="report timings and counters to stderr",
+    )
+    parser.add_argument(
+        "--stats-json",
+        metavar="FILE",
+        help="write timings and counters as JSON to FILE",
+    )
+    parser.add_argument(
+        "--slowest",
+        type=int,
+        default=0,
+        metavar="N",
+        help="report the N entries which took longest to render",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="profile the conversion and write a pstats file to FILE "
+        "(collapsed stacks of a sampling profiler if FILE ends in "
+        ".collapsed or .folded)",
+    )
     parser.add_argument(
         "-V",
         "--version",
@@ -70,27 +291,135 @@ def cli():
         version=f"%(prog)s {beancount2ledger.__version__}",
     )
 
+    args = parser.parse_args()
+    args.cache = args.cache or args.cache_file is not None
+    # Config errors are reported before the books are loaded
+    config = get_config(args.config)
+    formats = args.format or [default]
+    outputs = args.output or []
+    if len(formats) > 1:
+        if len(outputs) != len(formats):
+            parser.error("each --format needs its own --output")
+        if args.watch or args.tree or args.only or args.price_db:
+            parser.error(
+                "several formats can't be used with --watch, --tree, --only "
+                "or --price-db"
+            )
+        if args.jobs != 1 or args.cache:
+            parser.error("several formats can't be used with --jobs or --cache")
+    elif len(outputs) > 1:
+        parser.error("only one --output can be given for each --format")
+    args.format = formats[0]
+    args.output = outputs[0] if outputs else None
+    selecting = args.begin or args.end or args.account
+    if selecting and (args.watch or args.tree):
+        parser.error(
+            "--begin, --end and --account can't be used with --watch or --tree"
+        )
+    if args.price_db and (args.watch or args.tree or args.only):
+        parser.error("--price-db can't be used with --watch, --tree or --only")
+    if args.watch:
+        if not args.output or args.file == "-":
+            parser.error("--watch requires a file and --output")
+        watch.watch(args.file, args.output, args.format, config)
+        return
+    if args.tree:
+        if args.output or args.file == "-":
+            parser.error("--tree requires a file and can't be used with --output")
+        try:
+            written, outputs = convert_tree(args.file, args.tree, args.format, config)
+        except ValueError as e:
+            sys.exit(f"beancount2ledger: {e}")
+        print(f"wrote {len(written)} of {len(outputs)} files", file=sys.stderr)
+        return
+
     with contextlib.ExitStack() as stack:
-        args = parser.parse_args()
-        in_file = args.file
-
-        # beancount loader does not accept file objects, hence to support reading from
-        # stdin we write its content to a tempfile and call the loader on its path
-        if in_file == "-":
-            tmpfile = stack.enter_context(
-                NamedTemporaryFile(
-                    prefix="tmp.beancount2ledger.",
-                    mode="w",
-                    encoding=locale.getpreferredencoding(),
-                )
+
+        if args.profile:
+            stack.enter_context(profile(args.profile))
+
+        cache = None
+        if args.cache:
+            cache = stack.enter_context(RenderCache(args.cache_file, args.cache_size))
+
+        stats = None
+        if args.stats or args.stats_json or args.slowest:
+            stats = ConversionStats(args.slowest)
+
+        # Input from stdin is parsed from memory; files it includes are
+        # relative to the current directory
+        if args.file == "-":
+            entries, options_map = beancount2ledger.load_string(sys.stdin.read(), stats)
+        else:
+            entries, options_map = beancount2ledger.load_file(args.file, stats)
+
+        if args.only == "prices":
+            # Prices are shown with full precision so they don't need the
+            # display context
+            entries = price_entries(entries)
+            dcontext = None
+        else:
+            # Selected entries are formatted like in the output of all
+            # entries
+            dcontext = beancount2ledger.build_dcontext(entries, stats)
+        try:
+            entries = beancount2ledger.select_entries(
+                entries,
+                options_map,
+                args.begin,
+                args.end,
+                args.account,
+                args.opening_balances,
+                stats,
+            )
+        except ValueError as e:
+            parser.error(str(e))
+
+        streams = [stack.enter_context(atomic_open(path)) for path in outputs]
+        out = streams[0] if streams else sys.stdout
+        prices = None
+        if args.price_db:
+            prices = stack.enter_context(atomic_open(args.price_db))
+
+        if args.only == "prices":
+            convert_prices_to(entries, out, config, args.dedupe_prices)
+        elif len(formats) > 1:
+            beancount2ledger.convert_to_many(
+                entries, list(zip(formats, streams)), dcontext, config, stats=stats
+            )
+            for stream in streams:
+                stream.write("\n")
+        else:
+            beancount2ledger.convert_to(
+                entries,
+                out,
+                args.format,
+                dcontext,
+                config=config,
+                jobs=args.jobs,
+                cache=cache,
+                stats=stats,
+                price_stream=prices,
             )
-            tmpfile.write(sys.stdin.read())
-            tmpfile.flush()
-            in_file = tmpfile.name
+            out.write("\n")
 
-        config = get_config(args.config)
-        output = beancount2ledger.convert_file(in_file, args.format, config=config)
-        print(output)
+    if args.slowest:
+        stats.report_slowest(sys.stderr)
+    if args.stats or args.stats_json:
+        if cache is not None:
+            stats.cache = cache.stats()
+        if args.stats:
+            stats.report(sys.stderr)
+        if args.stats_json:
+            with open(args.stats_json, "w") as stats_stream:
+                stats.write_json(stats_stream)
+    elif cache is not None:
+        print(
+            "cache: {hits} hits, {misses} misses, {evicted} evicted".format(
+                **cache.stats()
+            ),
+            file=sys.stderr,
+        )
 
 
 if __name__ == "__main__":
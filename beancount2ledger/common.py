@@ -10,13 +10,38 @@ __license__ = "GPL-2.0-or-later"
 
 import re
 import sys
+import threading
+import weakref
 
 from beancount.core import data
 from beancount.core import convert
 from beancount.core import amount
+from beancount.core import interpolate
+from beancount.core.number import Decimal
 
 ROUNDING_ACCOUNT = "Equity:Rounding"
 
+# Narration of the transactions beancount inserts for pad entries, with
+# the account of the balance assertion they pad
+PADDING_RE = re.compile(r"\(Padding inserted for Balance of (.+) for difference")
+
+# Config options and the types of their values
+CONFIG_OPTIONS = {
+    "indent": int,
+    "auxdate": str,
+    "postdate": str,
+    "code": str,
+    "payee-meta": str,
+    "account_map": dict,
+    "currency_map": dict,
+}
+
+# Names of the types of config options in error messages
+CONFIG_TYPE_NAMES = {int: "an integer", str: "a string", dict: "a mapping"}
+
+# Cache of display_quantum() for each DisplayFormatter
+_display_quanta = weakref.WeakKeyDictionary()
+
 
 def ledger_flag(flag):
     """
@@ -92,6 +117,25 @@ def postings_by_type(entry):
     return (postings_simple, postings_at_price, postings_at_cost)
 
 
+def cost_needs_price(entry):
+    """
+    Return True if postings held at cost need a price in ledger
+
+    This is the case if the transaction has more than two postings and
+    no posting without an amount.
+    See https://groups.google.com/d/msg/ledger-cli/35hA0Dvhom0/WX8gY_5kHy0J
+    and https://github.com/ledger/ledger/issues/630
+    """
+
+    if len(entry.postings) <= 2:
+        return False
+    (postings_simple, _, __) = postings_by_type(entry)
+    return not any(
+        posting.units is None or is_automatic_posting(posting)
+        for posting in postings_simple
+    )
+
+
 def split_currency_conversions(entry):
     """If the transaction has a mix of conversion at cost and a
     currency conversion, split the transaction into two transactions: one
@@ -157,6 +201,38 @@ def split_currency_conversions(entry):
     return converted, new_entries
 
 
+def validate_config(config):
+    """
+    Check that config only has known options with values of the right
+    type, raising ValueError otherwise
+    """
+
+    if not isinstance(config, dict):
+        raise ValueError("Invalid config: expected a mapping of options")
+    for key, value in config.items():
+        if key not in CONFIG_OPTIONS:
+            raise ValueError(f"Unknown config option {key!r}")
+        expected = CONFIG_OPTIONS[key]
+        # Options other than indent can be left empty
+        if value is None and expected is not int:
+            continue
+        # bool is a subclass of int but not a valid number of spaces
+        if not isinstance(value, expected) or isinstance(value, bool):
+            raise ValueError(
+                f"Config option {key!r} must be {CONFIG_TYPE_NAMES[expected]}, "
+                f"not {value!r}"
+            )
+        if expected is dict:
+            for name, mapped in value.items():
+                if not isinstance(name, str) or not isinstance(mapped, str):
+                    raise ValueError(
+                        f"Config option {key!r} must map names to names, "
+                        f"not {name!r} to {mapped!r}"
+                    )
+    if config.get("indent", 0) < 0:
+        raise ValueError("Config option 'indent' must not be negative")
+
+
 def set_default(config):
     """
     Set some defaults for the config
@@ -167,6 +243,54 @@ def set_default(config):
     return config
 
 
+class Options:
+    """
+    Config options compiled for rendering.
+
+    The config is checked and the values needed for each transaction
+    and posting are computed once: the indentation of postings and of
+    their metadata, the width of the amount column of ledger and the
+    metadata keys.  Options can't be changed.
+    """
+
+    __slots__ = (
+        "config",
+        "indent",
+        "posting_indent",
+        "meta_indent",
+        "amount_width",
+        "hledger_amount_width",
+        "auxdate",
+        "postdate",
+        "code",
+        "payee_meta",
+    )
+
+    def __init__(self, config={}):
+        validate_config(config)
+        config = set_default(dict(config))
+        indent = config["indent"]
+        init = super().__setattr__
+        init("config", config)
+        init("indent", indent)
+        init("posting_indent", " " * indent)
+        init("meta_indent", " " * (2 * indent))
+        # Width available for the amount and the account: 75 columns
+        # minus the indentation of postings and two spaces separating
+        # the account from the amount
+        init("amount_width", 75 - (indent + 2))
+        # hledger output is 76 columns wide and its amounts are aligned
+        # for postings indented by 2 spaces, whatever the indent
+        init("hledger_amount_width", 76 - (2 + 2))
+        init("auxdate", config.get("auxdate"))
+        init("postdate", config.get("postdate"))
+        init("code", config.get("code"))
+        init("payee_meta", config.get("payee-meta"))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Options can't be changed: {name}")
+
+
 def user_meta(meta):
     """
     Get user defined metadata, i.e. skip some automatically added keys
@@ -203,59 +327,236 @@ def is_automatic_posting(posting):
     return False
 
 
+def has_residual(entry):
+    """
+    Return False if the postings of entry certainly balance exactly.
+
+    This is a cheap check for the common case of postings without costs
+    or prices whose amounts add up to zero for each currency.  If it
+    returns True, the residual has to be computed.
+    """
+
+    totals = {}
+    for posting in entry.postings:
+        units = posting.units
+        if posting.cost is not None or posting.price is not None or units is None:
+            return True
+        if posting.meta and interpolate.AUTOMATIC_RESIDUAL in posting.meta:
+            return True
+        totals[units.currency] = totals.get(units.currency, 0) + units.number
+    return any(totals.values())
+
+
+def fill_residual_posting(entry):
+    """
+    Insert a posting to absorb the residual if necessary, like
+    interpolate.fill_residual_posting() but without computing the
+    residual for entries which balance exactly.
+    """
+
+    if not has_residual(entry):
+        return entry
+    return interpolate.fill_residual_posting(entry, ROUNDING_ACCOUNT)
+
+
+def display_quantum(dformat, currency):
+    """
+    Return the smallest amount of currency displayed by dformat, or None
+    if dformat shows all digits
+    """
+
+    quanta = _display_quanta.setdefault(dformat, {})
+    if currency not in quanta:
+        # Currencies unknown to the display context use the default format
+        key = currency if currency in dformat.fmtstrings else "__default__"
+        digits = dformat.dcontext.ccontexts[key].get_fractional(dformat.precision)
+        quanta[currency] = None if digits is None else Decimal(1).scaleb(-digits)
+    return quanta[currency]
+
+
 def filter_rounding_postings(entry, dformat):
     """
     Return entry without rounding postings that wouldn't be displayed
     because the display precision rounds them to 0.00.
     """
 
-    postings = list(entry.postings)
     new_postings = []
-    for posting in postings:
-        pos_str = posting.units.to_string(dformat)
-        # Don't create a posting if the amount (rounded to the display
-        # precision) is 0.00.
-        amt = amount.from_string(pos_str)
-        if amt or posting.account != ROUNDING_ACCOUNT:
-            new_postings.append(posting)
-    entry = entry._replace(postings=new_postings)
-    return entry
-
-
-def map_data(string, config):
+    for posting in entry.postings:
+        if posting.account == ROUNDING_ACCOUNT:
+            # Don't create a posting if the amount (rounded to the display
+            # precision) is 0.00.  Like formatting, rounding is half-even,
+            # so half of the smallest displayed amount is rounded to 0.
+            number = posting.units.number
+            quantum = display_quantum(dformat, posting.units.currency)
+            if quantum is None and not number:
+                continue
+            if quantum is not None and 2 * abs(number) <= quantum:
+                continue
+        new_postings.append(posting)
+    if len(new_postings) == len(entry.postings):
+        return entry
+    return entry._replace(postings=new_postings)
+
+
+class PreparedTransaction:
     """
-    Map accounts and currencies according to user-defined mappings.
+    A transaction prepared for rendering, shared by all output formats.
+
+    If the transaction was inserted by beancount for a pad entry, padded
+    is the account of the balance assertion it pads, and a balance
+    assignment is rendered instead.  Otherwise, meta is the user
+    metadata of entry, postings is a list of (posting, user metadata)
+    pairs in the order of the file and cost_price tells whether postings
+    held at cost need a price in ledger.  The metadata is shared, so
+    renderers must copy it before changing it.
     """
 
-    account_map = config.get("account_map", {})
-    currency_map = config.get("currency_map", {})
-
-    if not account_map and not currency_map:
-        return string
+    __slots__ = ("entry", "padded", "meta", "postings", "cost_price")
 
-    for account in account_map:
-        string = re.sub(rf"\b{account}(?=  |\t|$)", account_map[account], string)
+    def __init__(self, entry, padded=None, meta=None, postings=(), cost_price=False):
+        self.entry = entry
+        self.padded = padded
+        self.meta = meta
+        self.postings = postings
+        self.cost_price = cost_price
 
-    def map_currency(match):
-        currency = match.group(2)
-        return quote(currency_map.get(currency, currency))
 
-    string = re.sub(rf'(?<=\d\s)(")?({amount.CURRENCY_RE})\1?', map_currency, string)
+def prepare_transaction(entry, dformat, assignments=True):
+    """
+    Return a PreparedTransaction of transaction entry for rendering
+    amounts with dformat
+
+    Transactions inserted for pad entries are rendered as balance
+    assignments, unless assignments is false, in which case they are
+    rendered like other transactions, with the amounts computed by
+    beancount.
+
+    A posting absorbing the residual is inserted if necessary.  This is
+    sometimes needed because Ledger bases its balancing precision on
+    the *last* number of digits used on that currency.  This is
+    believed to be a bug, so instead, we simply insert a rounding
+    account to absorb the residual and precisely balance the
+    transaction.  Rounding postings which wouldn't be displayed (due to
+    precision rounding amounts to 0.00) are removed again.
+    """
 
-    return string
+    if assignments and entry.flag == "P":
+        match = PADDING_RE.match(entry.narration)
+        if match:
+            return PreparedTransaction(entry, padded=match.group(1))
+
+    entry = fill_residual_posting(entry)
+    entry = filter_rounding_postings(entry, dformat)
+
+    # If a posting without an amount is given and several amounts would
+    # be added when balancing, beancount will create several postings.
+    # But we ignore the amount on those postings (since they were added
+    # by beancount and not the user), which means we may end up with
+    # two or more postings with no amount, which is not valid.
+    # Therefore, only take *one* posting by looking at the line number.
+    postings = []
+    seen = set()
+    for posting in sorted(entry.postings, key=get_lineno):
+        # Postings added by plugins have no line number
+        lineno = (posting.meta or {}).get("lineno")
+        if lineno is not None:
+            if lineno in seen:
+                continue
+            seen.add(lineno)
+        postings.append((posting, user_meta(posting.meta or {})))
+    return PreparedTransaction(
+        entry, None, user_meta(entry.meta or {}), postings, cost_needs_price(entry)
+    )
+
+
+class Mapper:
+    """
+    Map accounts and currencies according to user-defined mappings.
 
+    The printers look up the names of accounts and currencies with
+    account_name(), currency_name() and quoted_currency() while
+    rendering.
+    """
 
-def gen_bal_assignment(entry, amt, indent):
+    def __init__(self, account_map=None, currency_map=None):
+        self.account_map = dict(account_map or {})
+        self.currency_map = dict(currency_map or {})
+        self.currencies = {}
+        # Numbers of names mapped by account_name() and the currency
+        # methods, kept for each thread so threads sharing the mapper
+        # don't lose counts
+        self.counts = threading.local()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a mapper from the mappings of a config
+        """
+
+        return cls(config.get("account_map"), config.get("currency_map"))
+
+    def __bool__(self):
+        return bool(self.account_map or self.currency_map)
+
+    @property
+    def substitutions(self):
+        """
+        Number of names mapped in the current thread
+        """
+
+        return getattr(self.counts, "substitutions", 0)
+
+    def account_name(self, account):
+        """
+        Return the mapped name of account
+        """
+
+        mapped = self.account_map.get(account)
+        if mapped is None:
+            return account
+        self.counts.substitutions = self.substitutions + 1
+        return mapped
+
+    def currency_name(self, currency):
+        """
+        Return the mapped name of currency
+        """
+
+        mapped = self.currency_map.get(currency)
+        if mapped is None:
+            return currency
+        self.counts.substitutions = self.substitutions + 1
+        return mapped
+
+    def quoted_currency(self, currency):
+        """
+        Return the mapped name of currency, quoted if necessary
+        """
+
+        quoted = self.currencies.get(currency)
+        if quoted is None:
+            quoted = quote(self.currency_map.get(currency, currency))
+            self.currencies[currency] = quoted
+        if currency in self.currency_map:
+            self.counts.substitutions = self.substitutions + 1
+        return quoted
+
+
+def gen_bal_assignment(entry, amt, indent, mapper=None):
     """
     Generate a balance assignment
     """
 
+    if mapper is None:
+        mapper = Mapper()
+    number, currency = amt.split(" ")
+    amt = f"{number} {mapper.quoted_currency(currency)}"
     string = f"{entry.date:%Y-%m-%d}"
-    src_acct = entry.postings[0].account
+    src_acct = mapper.account_name(entry.postings[0].account)
     string += f" Setting account {src_acct} to {amt}\n"
     amt = f"= {amt}"
     len_amt = max(0, 25 - len(indent))
     string += f"{indent}{src_acct:50}{amt:>{len_amt}}\n"
-    dest_acct = entry.postings[1].account
+    dest_acct = mapper.account_name(entry.postings[1].account)
     string += f"{indent}{dest_acct}"
     return string
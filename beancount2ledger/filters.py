@@ -0,0 +1,137 @@
+"""
+Selection of entries to convert
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import bisect
+import datetime
+import re
+
+from beancount.core import data
+from beancount.core import getters
+from beancount.ops import summarize
+from beancount.parser import options
+
+# Directives declaring accounts and commodities, which are kept even if
+# they are dated before the beginning of the selected period
+DECLARATIONS = (data.Open, data.Commodity)
+
+
+def parse_date(date):
+    """
+    Return date as a datetime.date, parsing it if it's a YYYY-MM-DD string
+    """
+
+    if date is None or isinstance(date, datetime.date):
+        return date
+    try:
+        return datetime.datetime.strptime(date, "%Y-%m-%d").date()
+    except ValueError:
+        raise ValueError(f"Invalid date {date!r}: expected YYYY-MM-DD") from None
+
+
+def compile_account(account):
+    """
+    Return the compiled regular expression account, or None
+    """
+
+    if account is None:
+        return None
+    try:
+        return re.compile(account)
+    except re.error as e:
+        raise ValueError(f"Invalid account regular expression: {e}") from None
+
+
+def opening_balances(entries, begin, options_map=None):
+    """
+    Return entries with the transactions before begin replaced by opening
+    balances at begin.
+
+    Like the OPEN clause of bean-query, income and expenses before begin
+    are transferred to the retained earnings account and balances are
+    summarized against the opening balances account, both named
+    according to options_map.
+    """
+
+    if options_map is None:
+        options_map = options.OPTIONS_DEFAULTS
+    entries, _ = summarize.open_opt(entries, begin, options_map)
+    return entries
+
+
+class DateIndex:
+    """
+    Index of entries sorted by date, selecting periods by bisection.
+    """
+
+    def __init__(self, entries):
+        dates = [entry.date for entry in entries]
+        if any(date > next_date for date, next_date in zip(dates, dates[1:])):
+            entries = sorted(entries, key=data.entry_sortkey)
+            dates = [entry.date for entry in entries]
+        self.entries = entries
+        self.dates = dates
+        self.declarations = [
+            i for i, entry in enumerate(entries) if isinstance(entry, DECLARATIONS)
+        ]
+
+    def select(self, begin=None, end=None, account=None):
+        """
+        Return the entries dated from begin (inclusive) to end (exclusive)
+        and involving an account matching the regular expression account.
+
+        Account and commodity declarations before begin are kept so the
+        accounts and commodities used by the selected entries are
+        declared.  Entries which involve no account, such as prices, are
+        kept when filtering by account.
+        """
+
+        begin = parse_date(begin)
+        end = parse_date(end)
+        account = compile_account(account)
+
+        start = 0 if begin is None else bisect.bisect_left(self.dates, begin)
+        stop = len(self.dates) if end is None else bisect.bisect_left(self.dates, end)
+        declared = bisect.bisect_left(self.declarations, min(start, stop))
+        selected = [self.entries[i] for i in self.declarations[:declared]]
+        selected.extend(self.entries[start:stop])
+        if account is None:
+            return selected
+        return [entry for entry in selected if involves(entry, account)]
+
+
+def involves(entry, account):
+    """
+    Return whether entry involves an account matching the compiled
+    regular expression account, or no account at all
+    """
+
+    accounts = getters.get_entry_accounts(entry)
+    return not accounts or any(account.match(name) for name in accounts)
+
+
+def filter_entries(
+    entries, begin=None, end=None, account=None, opening=False, options_map=None
+):
+    """
+    Return the entries dated from begin (inclusive) to end (exclusive)
+    and involving an account matching the regular expression account.
+
+    If opening is true, the balances of accounts at begin are kept as
+    opening balances (see opening_balances()); otherwise, transactions
+    before begin are dropped and balances start from zero.  See
+    DateIndex.select() for the entries which are always kept.
+    """
+
+    begin = parse_date(begin)
+    if opening and begin is not None:
+        entries = opening_balances(entries, begin, options_map)
+        # Opening balances are dated just before begin
+        begin = None
+    return DateIndex(entries).select(begin, end, account)
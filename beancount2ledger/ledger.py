@@ -10,46 +10,135 @@ Convert Beancount entries to hledger
 __license__ = "GPL-2.0-or-later"
 
 import datetime
-import io
-import re
 
 from beancount.core.amount import Amount
 from beancount.core.inventory import Inventory
 from beancount.core.number import Decimal
+from beancount.core import data
 from beancount.core import position
-from beancount.core import amount
-from beancount.core import interpolate
 from beancount.core import display_context
 
-from .common import ROUNDING_ACCOUNT
-from .common import ledger_flag, ledger_str, quote_currency, postings_by_type, user_meta
+from .common import ledger_flag, ledger_str, quote_currency, user_meta
 from .common import (
-    set_default,
+    Options,
     gen_bal_assignment,
-    get_lineno,
     is_automatic_posting,
-    filter_rounding_postings,
+    prepare_transaction,
+    cost_needs_price,
+    Mapper,
 )
 
 
 class LedgerPrinter:
-    "Multi-method for printing directives in Ledger format."
+    """
+    Multi-method for printing directives in Ledger format.
+
+    Each directive method appends the parts of its output to the list
+    out, so a printer holds no state while rendering, apart from the
+    counts of mapped names its mapper keeps for each thread, and can be
+    used by several threads at once.
+
+    Entries are rendered by the method named after their type, looked
+    up once per type in a dispatch table.  Other handlers can be given
+    as handlers, a dict of types and functions, or with register().
+    """
 
     # pylint: disable=invalid-name
 
-    def __init__(self, dcontext=None, config={}):
-        self.io = None
+    def __init__(self, dcontext=None, config={}, handlers=None):
         self.dcontext = dcontext or display_context.DEFAULT_DISPLAY_CONTEXT
         self.dformat = self.dcontext.build(
             precision=display_context.Precision.MOST_COMMON
         )
-        self.config = set_default(config)
+        self.options = Options(config)
+        self.config = self.options.config
+        self.mapper = Mapper.from_config(self.config)
+        self.handlers = {
+            entry_type: getattr(self, entry_type.__name__)
+            for entry_type in data.ALL_DIRECTIVES
+        }
+        for entry_type, handler in (handlers or {}).items():
+            self.register(entry_type, handler)
 
     def __call__(self, obj):
-        self.io = io.StringIO()
-        method = getattr(self, obj.__class__.__name__)
-        method(obj)
-        return self.io.getvalue()
+        out = []
+        self.render_to(obj, out)
+        return "".join(out)
+
+    def register(self, entry_type, handler):
+        """
+        Render entries of entry_type with handler(entry, out), which
+        appends the parts of the output to the list out
+        """
+
+        self.handlers[entry_type] = handler
+
+    def handler(self, entry_type):
+        """
+        Return the handler of entry_type, looking up the method named
+        after it if none was registered
+        """
+
+        handler = self.handlers.get(entry_type)
+        if handler is None:
+            handler = self.handlers[entry_type] = getattr(self, entry_type.__name__)
+        return handler
+
+    def render_to(self, entry, out):
+        """
+        Append the parts of the output of entry to the list out
+        """
+
+        handler = self.handlers.get(entry.__class__) or self.handler(entry.__class__)
+        handler(entry, out)
+
+    def render_all(self, entries, separator="\n"):
+        """
+        Return the output of entries, separated by separator, rendering
+        all of them into a single list of parts
+        """
+
+        out = []
+        append = out.append
+        handlers = self.handlers
+        for i, entry in enumerate(entries):
+            if i:
+                append(separator)
+            handler = handlers.get(entry.__class__) or self.handler(entry.__class__)
+            handler(entry, out)
+        return "".join(out)
+
+    def prepare(self, entry):
+        """
+        Return transaction entry prepared for rendering (see
+        prepare_transaction())
+        """
+
+        return prepare_transaction(entry, self.dformat)
+
+    def format_amount(self, amt, dformat=None, quoted=True):
+        """
+        Format an amount with the mapped currency, quoted if necessary
+        unless quoted is false
+        """
+
+        number = amt.number
+        if isinstance(number, Decimal):
+            number = (dformat or self.dformat).format(number, amt.currency)
+        if quoted:
+            return f"{number} {self.mapper.quoted_currency(amt.currency)}"
+        return f"{number} {self.mapper.currency_name(amt.currency)}"
+
+    def format_cost(self, cost):
+        """
+        Format the amount of a cost with full precision
+        """
+
+        if not isinstance(cost.number, Decimal):
+            return ""
+        return self.format_amount(
+            Amount(cost.number, cost.currency), display_context.DEFAULT_FORMATTER
+        )
 
     def format_meta(self, key, val):
         """
@@ -64,6 +153,7 @@ class LedgerPrinter:
             sep = "::"
         elif isinstance(val, Amount):
             sep = "::"
+            val = self.format_amount(val, display_context.DEFAULT_FORMATTER, False)
         elif isinstance(val, datetime.date):
             sep = "::"
             val = f"[{val}]"
@@ -79,37 +169,25 @@ class LedgerPrinter:
             raise ValueError(f"Unexpected metadata type: {type(val)}")
         return f"{key}{sep} {val}"
 
-    def Transaction(self, entry):
+    def Transaction(self, entry, out):
         """Transactions"""
 
-        indent = " " * self.config["indent"]
+        options = self.options
+        indent = options.posting_indent
 
-        if entry.flag == "P":
-            match = re.match(
-                r"\(Padding inserted for Balance of (.+) for difference",
-                entry.narration,
-            )
-            if match:
-                string = gen_bal_assignment(entry, match.group(1), indent)
-                self.io.write(string)
-                return
-
-        # Insert a posting to absorb the residual if necessary. This is
-        # sometimes needed because Ledger bases its balancing precision on the
-        # *last* number of digits used on that currency. This is believed to be
-        # a bug, so instead, we simply insert a rounding account to absorb the
-        # residual and precisely balance the transaction.
-        entry = interpolate.fill_residual_posting(entry, ROUNDING_ACCOUNT)
-        # Remove postings which wouldn't be displayed (due to precision
-        # rounding amounts to 0.00)
-        entry = filter_rounding_postings(entry, self.dformat)
-
-        meta = user_meta(entry.meta or {})
+        txn = self.prepare(entry)
+        if txn.padded:
+            string = gen_bal_assignment(txn.entry, txn.padded, indent, self.mapper)
+            out.append(string)
+            return
+
+        entry = txn.entry
+        meta = dict(txn.meta)
 
         # Compute the string for the payee and narration line.
         strings = []
         if entry.payee:
-            payee_meta = self.config.get("payee-meta")
+            payee_meta = options.payee_meta
             if payee_meta:
                 meta[payee_meta] = entry.payee
             else:
@@ -117,57 +195,49 @@ class LedgerPrinter:
         if entry.narration:
             strings.append(ledger_str(entry.narration))
 
-        self.io.write(f"{entry.date:%Y-%m-%d}")
-        auxdate_key = self.config.get("auxdate")
+        out.append(f"{entry.date:%Y-%m-%d}")
+        auxdate_key = options.auxdate
         if auxdate_key and isinstance(meta.get(auxdate_key), datetime.date):
-            self.io.write(f"={meta[auxdate_key]:%Y-%m-%d}")
+            out.append(f"={meta[auxdate_key]:%Y-%m-%d}")
             del meta[auxdate_key]
         flag = ledger_flag(entry.flag)
         if flag:
-            self.io.write(" " + flag)
-        code_key = self.config.get("code")
+            out.append(" " + flag)
+        code_key = options.code
         if code_key and not meta.get(code_key) is None:
             code = meta[code_key]
-            self.io.write(" (" + str(code) + ")")
+            out.append(" (" + str(code) + ")")
             del meta[code_key]
         payee = " ".join(strings)
         if payee:
-            self.io.write(" " + payee)
-        self.io.write("\n")
+            out.append(" " + payee)
+        out.append("\n")
 
         if entry.tags:
-            self.io.write(indent + "; :{}:\n".format(":".join(sorted(entry.tags))))
+            out.append(indent + "; :{}:\n".format(":".join(sorted(entry.tags))))
         if entry.links:
-            self.io.write(
-                indent + "; Link: {}\n".format(", ".join(sorted(entry.links)))
-            )
+            out.append(indent + "; Link: {}\n".format(", ".join(sorted(entry.links))))
 
         for key, val in meta.items():
             formatted_meta = self.format_meta(key, val)
             if meta:
-                self.io.write(indent + f"; {formatted_meta}\n")
-
-        # If a posting without an amount is given and several amounts would
-        # be added when balancing, beancount will create several postings.
-        # But we ignore the amount on those postings (since they were added
-        # by beancount and not the user), which means we may end up with
-        # two or more postings with no amount, which is not valid.
-        # Therefore, only take *one* posting by looking at the line number.
-        seen = set()
-        for posting in sorted(entry.postings, key=lambda p: get_lineno(p)):
-            lineno = get_lineno(posting)
-            if lineno is not None:
-                if lineno in seen:
-                    continue
-                seen.add(lineno)
-            self.Posting(posting, entry)
-
-    def Posting(self, posting, entry):
-        """Postings"""
+                out.append(indent + f"; {formatted_meta}\n")
+
+        for posting, posting_meta in txn.postings:
+            self.Posting(posting, entry, out, txn.cost_price, posting_meta)
+
+    def Posting(self, posting, entry, out, cost_price=None, meta=None):
+        """Postings
+
+        cost_price tells whether a posting held at cost needs a price; it's
+        computed from entry if it's not given.  meta is the user metadata
+        of the posting, extracted from posting if it's not given.
+        """
 
         assert posting.account is not None
+        options = self.options
         flag = f"{ledger_flag(posting.flag)} " if ledger_flag(posting.flag) else ""
-        flag_posting = f"{flag}{posting.account}"
+        flag_posting = f"{flag}{self.mapper.account_name(posting.account)}"
 
         pos_str = ""
         # We don't use position.to_string() because that uses the same
@@ -175,41 +245,29 @@ class LedgerPrinter:
         # dcontext to format amounts to the right precision while
         # retaining the full precision for costs.
         if isinstance(posting.units, Amount):
-            pos_str = posting.units.to_string(self.dformat)
+            pos_str = self.format_amount(posting.units)
         # We can't use default=True, even though we're interested in the
         # cost details, but we have to add them ourselves in the format
         # expected by ledger.
         if isinstance(posting.cost, position.Cost):
-            pos_str += (
-                " {"
-                + position.cost_to_str(
-                    posting.cost, display_context.DEFAULT_FORMATTER, detail=False
-                )
-                + "}"
-            )
+            pos_str += " {" + self.format_cost(posting.cost) + "}"
         if posting.cost:
             if posting.cost.date != entry.date:
                 pos_str += f" [{posting.cost.date}]"
             if posting.cost.label:
-                pos_str += f" ({posting.cost.label})"
+                pos_str += f" ({quote_currency(posting.cost.label)})"
 
         if posting.price is not None:
-            price_str = "@ {}".format(posting.price.to_string())
+            price_str = "@ {}".format(
+                self.format_amount(posting.price, display_context.DEFAULT_FORMATTER)
+            )
         else:
             # Figure out if we need to insert a price on a posting held at cost.
-            # See https://groups.google.com/d/msg/ledger-cli/35hA0Dvhom0/WX8gY_5kHy0J
-            # and https://github.com/ledger/ledger/issues/630
-            (postings_simple, _, __) = postings_by_type(entry)
-            postings_no_amount = [
-                posting
-                for posting in postings_simple
-                if posting.units is None or is_automatic_posting(posting)
-            ]
+            if cost_price is None:
+                cost_price = cost_needs_price(entry)
             cost = posting.cost
-            if cost and not postings_no_amount and len(entry.postings) > 2:
-                price_str = "@ {}".format(
-                    amount.Amount(cost.number, cost.currency).to_string()
-                )
+            if cost and cost_price:
+                price_str = "@ {}".format(self.format_cost(cost))
             else:
                 price_str = ""
 
@@ -217,35 +275,31 @@ class LedgerPrinter:
             posting_str = f"{flag_posting}"
         else:
             # Width we have available for the amount: take width of
-            # flag_posting add config["indent"] for the indentation
-            # of postings and add 2 to separate account from amount
-            len_amount = max(0, 75 - (len(flag_posting) + self.config["indent"] + 2))
-            posting_str = (
-                f"{flag_posting}  {quote_currency(pos_str):>{len_amount}}"
-                f" {quote_currency(price_str)}"
-            )
-        indent = " " * self.config["indent"]
-        self.io.write(indent + posting_str.rstrip())
-        meta = user_meta(posting.meta or {})
+            # flag_posting from the width left by the indentation of
+            # postings and the 2 spaces separating account from amount
+            len_amount = max(0, options.amount_width - len(flag_posting))
+            posting_str = f"{flag_posting}  {pos_str:>{len_amount}} {price_str}"
+        out.append(options.posting_indent + posting_str.rstrip())
+        meta = user_meta(posting.meta or {}) if meta is None else dict(meta)
         dates = []
-        postdate_key = self.config.get("postdate")
+        postdate_key = options.postdate
         if postdate_key and isinstance(meta.get(postdate_key), datetime.date):
             dates.append(str(meta[postdate_key]))
             del meta[postdate_key]
-        auxdate_key = self.config.get("auxdate")
+        auxdate_key = options.auxdate
         if auxdate_key and isinstance(meta.get(auxdate_key), datetime.date):
             dates.append("=" + str(meta[auxdate_key]))
             del meta[auxdate_key]
         if dates:
-            self.io.write("  ; [" + "".join(dates) + "]")
-        self.io.write("\n")
+            out.append("  ; [" + "".join(dates) + "]")
+        out.append("\n")
 
         for key, val in meta.items():
             formatted_meta = self.format_meta(key, val)
             if meta:
-                self.io.write(2 * indent + f"; {formatted_meta}\n")
+                out.append(options.meta_indent + f"; {formatted_meta}\n")
 
-    def Balance(self, entry):
+    def Balance(self, entry, out):
         """Balance entries"""
 
         # We cannot output balance directive equivalents because Ledger only
@@ -253,21 +307,19 @@ class LedgerPrinter:
         # Assertions for Beancount" for details:
         # https://docs.google.com/document/d/1vyemZFox47IZjuBrT2RjhSHZyTgloYOUeJb73RxMRD0/
 
-    def Note(self, entry):
+    def Note(self, entry, out):
         """Note entries"""
 
-        self.io.write(
-            ";; Note: {e.date:%Y-%m-%d} {e.account} {e.comment}\n".format(e=entry)
-        )
+        account = self.mapper.account_name(entry.account)
+        out.append(f";; Note: {entry.date:%Y-%m-%d} {account} {entry.comment}\n")
 
-    def Document(self, entry):
+    def Document(self, entry, out):
         """Document entries"""
 
-        self.io.write(
-            ";; Document: {e.date:%Y-%m-%d} {e.account} {e.filename}\n".format(e=entry)
-        )
+        account = self.mapper.account_name(entry.account)
+        out.append(f";; Document: {entry.date:%Y-%m-%d} {account} {entry.filename}\n")
 
-    def Pad(self, entry):
+    def Pad(self, entry, out):
         """Pad entries"""
 
         # Note: We don't need to output these because when we're loading the
@@ -275,57 +327,62 @@ class LedgerPrinter:
         # automatically.  We special-case these automatically padding
         # entries to generate a ledger balance assignment.
 
-    def Commodity(self, entry):
+    def Commodity(self, entry, out):
         "Commodity declarations" ""
 
         # No need for declaration.
-        self.io.write("commodity {e.currency}\n".format(e=entry))
+        out.append(f"commodity {self.mapper.currency_name(entry.currency)}\n")
 
-    def Open(self, entry):
+    def Open(self, entry, out):
         """Account open statements"""
 
-        self.io.write("account {e.account}\n".format(e=entry))
+        out.append(f"account {self.mapper.account_name(entry.account)}\n")
         if entry.currencies:
-            self.io.write(
+            out.append(
                 "  assert {}\n".format(
                     " | ".join(
-                        'commodity == "{}"'.format(currency)
+                        'commodity == "{}"'.format(self.mapper.currency_name(currency))
                         for currency in entry.currencies
                     )
                 )
             )
 
-    def Close(self, entry):
+    def Close(self, entry, out):
         """Account close statements"""
 
-        self.io.write(";; Close: {e.date:%Y-%m-%d} close {e.account}\n".format(e=entry))
+        account = self.mapper.account_name(entry.account)
+        out.append(f";; Close: {entry.date:%Y-%m-%d} close {account}\n")
 
-    def Price(self, entry):
+    def Price(self, entry, out):
         """Price entries"""
 
-        self.io.write(
+        out.append(
             "P {:%Y-%m-%d} {:<26} {:>35}\n".format(
-                entry.date, quote_currency(entry.currency), str(entry.amount)
+                entry.date,
+                self.mapper.quoted_currency(entry.currency),
+                self.format_amount(
+                    entry.amount, display_context.DEFAULT_FORMATTER, False
+                ),
             )
         )
 
-    def Event(self, entry):
+    def Event(self, entry, out):
         """Event entries"""
 
-        self.io.write(
+        out.append(
             ';; Event: {e.date:%Y-%m-%d} "{e.type}" "{e.description}"\n'.format(e=entry)
         )
 
-    def Query(self, entry):
+    def Query(self, entry, out):
         """Query entries"""
 
-        self.io.write(
+        out.append(
             ';; Query: {e.date:%Y-%m-%d} "{e.name}" "{e.query_string}"\n'.format(
                 e=entry
             )
         )
 
-    def Custom(self, entry):
+    def Custom(self, entry, out):
         """Custom entries"""
 
         # Don't render anything.
@@ -0,0 +1,59 @@
+"""
+Writing of output files
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import contextlib
+import os
+import stat
+import tempfile
+
+# Size of the write buffer of output files
+BUFFER_SIZE = 1024 * 1024
+
+
+def file_mode(path):
+    """
+    Return the permissions of path if it exists, or the permissions of a
+    new file according to the umask
+    """
+
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+@contextlib.contextmanager
+def atomic_open(path, encoding="utf-8", buffering=BUFFER_SIZE):
+    """
+    Context manager returning a text stream which replaces path when the
+    block is done.
+
+    The output is written to a temporary file in the same directory,
+    which is renamed to path at the end, so readers of path never see a
+    partly written file.  If the block raises an exception, path is left
+    untouched.
+    """
+
+    path = os.fspath(path)
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory)
+    try:
+        os.fchmod(fd, file_mode(path))
+        with open(fd, "w", encoding=encoding, buffering=buffering) as stream:
+            yield stream
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
@@ -0,0 +1,86 @@
+"""
+Fast export of prices
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+from beancount.core import data
+from beancount.core.number import Decimal
+
+from .common import Mapper
+
+# Number of prices written to the stream at a time
+CHUNK_SIZE = 1000
+
+
+def price_entries(entries):
+    """
+    Return the price entries of entries
+    """
+
+    return [entry for entry in entries if isinstance(entry, data.Price)]
+
+
+def price_lines(entries, config={}, dedupe=False):
+    """
+    Yield a compact ledger P directive for each price entry of entries
+
+    Unlike the conversion of all entries, no display context is needed
+    since prices are shown with their full precision.  If dedupe is
+    true, prices with the same date, commodity and amount as a previous
+    one are skipped.
+    """
+
+    mapper = Mapper.from_config(config)
+    # Many prices share a date, so formatted dates are reused
+    dates = {}
+    seen = set()
+    for entry in entries:
+        if not isinstance(entry, data.Price):
+            continue
+        amount = entry.amount
+        if dedupe:
+            key = (entry.date, entry.currency, amount.number, amount.currency)
+            if key in seen:
+                continue
+            seen.add(key)
+        number = amount.number
+        if isinstance(number, Decimal):
+            number = format(number, "f")
+        date = dates.get(entry.date)
+        if date is None:
+            date = dates[entry.date] = f"{entry.date:%Y-%m-%d}"
+        yield (
+            f"P {date} {mapper.quoted_currency(entry.currency)} "
+            f"{number} {mapper.currency_name(amount.currency)}\n"
+        )
+
+
+def convert_prices(entries, config={}, dedupe=False):
+    """
+    Return a price database in ledger format with the prices of entries
+    """
+
+    return "".join(price_lines(entries, config, dedupe))
+
+
+def convert_prices_to(entries, stream, config={}, dedupe=False):
+    """
+    Write a price database in ledger format with the prices of entries
+    to stream, returning the number of prices written
+    """
+
+    lines = []
+    count = 0
+    for line in price_lines(entries, config, dedupe):
+        lines.append(line)
+        if len(lines) >= CHUNK_SIZE:
+            stream.write("".join(lines))
+            count += len(lines)
+            lines = []
+    stream.write("".join(lines))
+    return count + len(lines)
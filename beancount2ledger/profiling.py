@@ -0,0 +1,128 @@
+"""
+Profiling of conversions
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import collections
+import contextlib
+import cProfile
+from pathlib import Path
+import sys
+import threading
+
+# Seconds between two samples of the sampling profiler
+SAMPLE_INTERVAL = 0.001
+
+# Suffixes of files written as collapsed stacks instead of pstats
+COLLAPSED_SUFFIXES = (".collapsed", ".folded")
+
+
+def frame_name(frame):
+    """
+    Return the name of the function of frame in a collapsed stack
+    """
+
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """
+    Sampling profiler recording the stack of a thread at regular
+    intervals from a background thread.
+
+    Its overhead is much lower than the one of cProfile, so timings are
+    closer to the ones of a normal run.  Stacks are written in the
+    collapsed format read by flamegraph tools: one line per stack with
+    its frames separated by semicolons, followed by the number of
+    samples.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.thread_id = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def sample(self):
+        """
+        Record the current stack of the profiled thread
+        """
+
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(frame_name(frame))
+            frame = frame.f_back
+        if stack:
+            self.samples[";".join(reversed(stack))] += 1
+
+    def run(self):
+        """
+        Record samples until stopped
+        """
+
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        """
+        Start sampling the current thread
+        """
+
+        self.thread_id = threading.get_ident()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop sampling
+        """
+
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, stream):
+        """
+        Write the samples to stream as collapsed stacks
+        """
+
+        for stack, count in sorted(self.samples.items()):
+            stream.write(f"{stack} {count}\n")
+
+
+@contextlib.contextmanager
+def profile(path, interval=SAMPLE_INTERVAL):
+    """
+    Context manager profiling its block and writing the profile to path
+
+    If path ends in .collapsed or .folded, the block is profiled by a
+    Sampler and collapsed stacks are written; otherwise cProfile is used
+    and a pstats file is written, which can be loaded with the pstats
+    module or tools such as snakeviz.
+    """
+
+    path = Path(path)
+    if path.suffix in COLLAPSED_SUFFIXES:
+        sampler = Sampler(interval)
+        sampler.start()
+        try:
+            yield sampler
+        finally:
+            sampler.stop()
+            with open(path, "w") as stream:
+                sampler.write(stream)
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield profiler
+        finally:
+            profiler.disable()
+            profiler.dump_stats(str(path))
@@ -0,0 +1,328 @@
+"""
+Conversion server keeping parsed books in memory
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import collections
+import io
+import json
+import os
+from pathlib import Path
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+from beancount import loader
+
+from . import build_dcontext, convert_to
+from .filters import DateIndex, filter_entries
+
+# Seconds between two checks for changes to the books
+POLL_INTERVAL = 1.0
+
+# Number of responses kept for identical requests on unchanged books
+MAX_RESPONSES = 8
+
+# Keys of a request and their default values
+REQUEST_DEFAULTS = {
+    "format": "ledger",
+    "config": {},
+    "begin": None,
+    "end": None,
+    "account": None,
+    "opening": False,
+}
+
+# Types of the values of a request and their description in errors
+REQUEST_TYPES = {
+    "format": ((str,), "a string"),
+    "config": ((dict,), "an object"),
+    "begin": ((str, type(None)), "a string or null"),
+    "end": ((str, type(None)), "a string or null"),
+    "account": ((str, type(None)), "a string or null"),
+    "opening": ((bool,), "a boolean"),
+}
+
+
+def default_socket_path():
+    """
+    Return the path of the default socket of the server
+    """
+
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return Path(runtime) / "beancount2ledger.sock"
+    return Path(tempfile.gettempdir()) / f"beancount2ledger-{os.getuid()}.sock"
+
+
+def mtime(file):
+    """
+    Return the modification time of file, or None if it doesn't exist
+    """
+
+    try:
+        return os.stat(file).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Books:
+    """
+    Entries of a beancount file kept in memory.
+
+    The file is loaded again when it or one of the files it includes is
+    modified.  Each load increments generation.
+    """
+
+    def __init__(self, file):
+        self.file = os.path.abspath(file)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.entries = []
+        self.dcontext = None
+        self.options_map = None
+        self.mtimes = {}
+        self.load()
+
+    def load(self):
+        """
+        Load the file and the files it includes
+        """
+
+        mtimes = {self.file: mtime(self.file)}
+        entries, errors, options_map = loader.load_file(self.file)
+        for file in options_map["include"]:
+            mtimes.setdefault(file, mtime(file))
+        self.entries = entries
+        self.dcontext = build_dcontext(entries)
+        self.options_map = options_map
+        self.mtimes = mtimes
+        self.generation += 1
+        return errors
+
+    def changed(self):
+        """
+        Return whether a loaded file was modified since it was loaded
+        """
+
+        return any(mtime(file) != loaded for file, loaded in self.mtimes.items())
+
+    def refresh(self):
+        """
+        Load the file again if it was modified and return a tuple of the
+        generation, entries and display context
+        """
+
+        with self.lock:
+            if self.changed():
+                errors = self.load()
+                print(
+                    f"reloaded {self.file}: {len(self.entries)} entries, "
+                    f"{len(errors)} errors",
+                    file=sys.stderr,
+                )
+            return self.generation, self.entries, self.dcontext
+
+
+def parse_request(line):
+    """
+    Parse a request, a JSON object on a single line, and return it with
+    default values filled in
+    """
+
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        raise ValueError(f"Invalid request: {e}") from None
+    if not isinstance(request, dict):
+        raise ValueError("Invalid request: expected a JSON object")
+    unknown = set(request) - set(REQUEST_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Invalid request: unknown keys {sorted(unknown)}")
+    for key, value in request.items():
+        types, description = REQUEST_TYPES[key]
+        if not isinstance(value, types):
+            raise ValueError(f"Invalid request: {key} must be {description}")
+    if request.get("format", "ledger") not in ("ledger", "hledger"):
+        raise ValueError(f"Invalid request: unknown format {request['format']!r}")
+    return {**REQUEST_DEFAULTS, **request}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handle a conversion request.
+
+    The request is a JSON object on one line.  The response is a JSON
+    object on one line, either {"ok": true} followed by the output or
+    {"error": message}.
+    """
+
+    def handle(self):
+        try:
+            request = parse_request(self.rfile.readline())
+            output = self.server.render(request)
+        except ValueError as e:
+            self.wfile.write(json.dumps({"error": str(e)}).encode("utf-8") + b"\n")
+            return
+        self.wfile.write(b'{"ok": true}\n')
+        self.wfile.write(output)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Server answering conversion requests for books on a Unix socket
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, books, config={}):
+        self.socket_path = str(socket_path)
+        self.books = books
+        self.config = config
+        self.responses = collections.OrderedDict()
+        self.responses_lock = threading.Lock()
+        self.index = (None, None)
+        remove_stale_socket(self.socket_path)
+        super().__init__(self.socket_path, RequestHandler)
+
+    def render(self, request):
+        """
+        Return the output for request, encoded as UTF-8
+        """
+
+        generation, entries, dcontext = self.books.refresh()
+        key = (generation, json.dumps(request, sort_keys=True))
+        with self.responses_lock:
+            if key in self.responses:
+                self.responses.move_to_end(key)
+                return self.responses[key]
+
+        if request["opening"] and request["begin"]:
+            entries = filter_entries(
+                entries,
+                request["begin"],
+                request["end"],
+                request["account"],
+                opening=True,
+                options_map=self.books.options_map,
+            )
+        else:
+            entries = self.date_index(generation, entries).select(
+                request["begin"], request["end"], request["account"]
+            )
+        stream = io.BytesIO()
+        convert_to(
+            entries,
+            stream,
+            request["format"],
+            dcontext,
+            {**self.config, **request["config"]},
+        )
+        stream.write(b"\n")
+        output = stream.getvalue()
+
+        with self.responses_lock:
+            self.responses[key] = output
+            while len(self.responses) > MAX_RESPONSES:
+                self.responses.popitem(last=False)
+        return output
+
+    def date_index(self, generation, entries):
+        """
+        Return the DateIndex of the entries of generation
+        """
+
+        with self.responses_lock:
+            if self.index[0] != generation:
+                self.index = (generation, DateIndex(entries))
+            return self.index[1]
+
+    def watch(self, interval=POLL_INTERVAL):
+        """
+        Reload the books in a background thread as soon as they change,
+        so requests don't wait for the reload
+        """
+
+        def poll():
+            while True:
+                self.books.refresh()
+                time.sleep(interval)
+
+        threading.Thread(target=poll, daemon=True).start()
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove the socket left by a server which is no longer running
+    """
+
+    if not os.path.exists(socket_path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)
+        else:
+            raise RuntimeError(f"A server is already listening on {socket_path}")
+
+
+def serve(file, socket_path=None, config={}, interval=POLL_INTERVAL):
+    """
+    Load file and answer conversion requests on socket_path until
+    interrupted
+    """
+
+    socket_path = socket_path or default_socket_path()
+    books = Books(file)
+    with Server(socket_path, books, config) as server:
+        server.watch(interval)
+        print(
+            f"serving {books.file} ({len(books.entries)} entries) on {socket_path}",
+            file=sys.stderr,
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def request(stream, socket_path=None, **params):
+    """
+    Send a conversion request with params to the server on socket_path
+    and write the output to the binary stream
+    """
+
+    try:
+        line = json.dumps(params)
+    except TypeError as e:
+        # Such as dates in a YAML config
+        raise ValueError(f"Invalid request: {e}") from None
+    socket_path = socket_path or default_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(socket_path))
+        sock.sendall(line.encode("utf-8") + b"\n")
+        with sock.makefile("rb") as response:
+            status = json.loads(response.readline() or "{}")
+            if "error" in status or not status.get("ok"):
+                raise ValueError(status.get("error", "No response from server"))
+            while True:
+                chunk = response.read(io.DEFAULT_BUFFER_SIZE)
+                if not chunk:
+                    break
+                stream.write(chunk)
@@ -0,0 +1,187 @@
+"""
+Timings and counters of conversions
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import contextlib
+import heapq
+import json
+import time
+
+
+def location(entry):
+    """
+    Return the file name and line number of entry
+    """
+
+    meta = entry.meta or {}
+    return f"{meta.get('filename', '<unknown>')}:{meta.get('lineno', 0)}"
+
+
+class ConversionStats:
+    """
+    Timings and counters collected during a conversion.
+
+    Attributes:
+      phases: A dict of phase name (load, dcontext, render) to a dict
+        with the wall and CPU time spent in that phase.
+      directives: A dict of directive type to a dict with the number of
+        entries of that type and the total time spent rendering them.
+      bytes: The number of bytes of output.
+      mappings: The number of account and currency names which were
+        substituted according to the mappings of the config.
+      cache: A dict of cache statistics if a cache was used, or None.
+      slowest: The number of slowest entries to keep.
+      slow_entries: A heap of (seconds, location, directive type) of the
+        slowest entries.
+    """
+
+    def __init__(self, slowest=0):
+        self.slowest = slowest
+        self.slow_entries = []
+        self.phases = {}
+        self.directives = {}
+        self.bytes = 0
+        self.mappings = 0
+        self.cache = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager adding the time spent in its block to phase name
+        """
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+            phase["wall"] += time.perf_counter() - wall
+            phase["cpu"] += time.process_time() - cpu
+
+    def add_directive(self, name, seconds):
+        """
+        Count a directive of type name which took seconds to render
+        """
+
+        directive = self.directives.setdefault(name, {"count": 0, "time": 0.0})
+        directive["count"] += 1
+        directive["time"] += seconds
+
+    def add_entry(self, entry, seconds):
+        """
+        Count entry which took seconds to render, keeping it if it's one
+        of the slowest entries
+        """
+
+        name = entry.__class__.__name__
+        self.add_directive(name, seconds)
+        if self.slowest:
+            self.add_slow_entry((seconds, location(entry), name))
+
+    def add_slow_entry(self, item):
+        """
+        Keep item if it's one of the slowest entries
+        """
+
+        if len(self.slow_entries) < self.slowest:
+            heapq.heappush(self.slow_entries, item)
+        elif item > self.slow_entries[0]:
+            heapq.heapreplace(self.slow_entries, item)
+
+    def slowest_entries(self):
+        """
+        Return the list of (seconds, location, directive type) of the
+        slowest entries, slowest first
+        """
+
+        return sorted(self.slow_entries, reverse=True)
+
+    def merge(self, other):
+        """
+        Add the directive counts and mappings of other, e.g. collected
+        in a worker process
+        """
+
+        for name, counts in other.directives.items():
+            directive = self.directives.setdefault(name, {"count": 0, "time": 0.0})
+            directive["count"] += counts["count"]
+            directive["time"] += counts["time"]
+        self.mappings += other.mappings
+        for item in other.slow_entries:
+            self.add_slow_entry(item)
+
+    @property
+    def entries(self):
+        """
+        The number of entries which were rendered
+        """
+
+        return sum(directive["count"] for directive in self.directives.values())
+
+    def as_dict(self):
+        """
+        Return the stats as a dict
+        """
+
+        return {
+            "phases": self.phases,
+            "directives": self.directives,
+            "entries": self.entries,
+            "bytes": self.bytes,
+            "mappings": self.mappings,
+            "cache": self.cache,
+            "slowest": [
+                {"location": loc, "directive": name, "time": seconds}
+                for seconds, loc, name in self.slowest_entries()
+            ],
+        }
+
+    def write_json(self, stream):
+        """
+        Write the stats to stream as JSON
+        """
+
+        json.dump(self.as_dict(), stream, indent=2)
+        stream.write("\n")
+
+    def report(self, stream):
+        """
+        Write a human readable report of the stats to stream
+        """
+
+        stream.write(f"{'phase':<20} {'wall (s)':>10} {'cpu (s)':>10}\n")
+        for name, phase in self.phases.items():
+            stream.write(f"{name:<20} {phase['wall']:>10.3f} {phase['cpu']:>10.3f}\n")
+        stream.write(f"\n{'directive':<20} {'count':>10} {'time (s)':>10}\n")
+        for name, directive in sorted(
+            self.directives.items(), key=lambda item: -item[1]["time"]
+        ):
+            stream.write(
+                f"{name:<20} {directive['count']:>10} {directive['time']:>10.3f}\n"
+            )
+        stream.write(
+            f"\nentries: {self.entries}, bytes: {self.bytes}, "
+            f"mapped names: {self.mappings}\n"
+        )
+        if self.cache is not None:
+            stream.write(
+                "cache: {hits} hits, {misses} misses, {evicted} evicted\n".format(
+                    **self.cache
+                )
+            )
+
+    def report_slowest(self, stream):
+        """
+        Write the slowest entries to stream
+        """
+
+        stream.write(f"{'slowest entries':<50} {'directive':<12} {'time (ms)':>10}\n")
+        for seconds, loc, name in self.slowest_entries():
+            stream.write(f"{loc:<50} {name:<12} {seconds * 1000:>10.3f}\n")
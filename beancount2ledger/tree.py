@@ -0,0 +1,221 @@
+"""
+Conversion of books to one output file per source file
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import functools
+import hashlib
+import json
+import os
+from pathlib import Path
+import time
+
+from beancount import loader
+from beancount.core import flags
+
+from . import build_dcontext, get_printer
+from .cache import MTIME_MARGIN, RenderCache, canonical
+from .common import prepare_transaction
+from .output import atomic_open
+
+# File in the output directory recording what each output was made from
+MANIFEST = ".beancount2ledger-tree.json"
+
+# Suffix of output files by output format
+SUFFIXES = {"ledger": ".ledger", "hledger": ".journal"}
+
+
+def output_path(source, root, suffix):
+    """
+    Return the path of the output of source, relative to the output
+    directory mirroring root
+    """
+
+    relative = Path(os.path.relpath(source, root))
+    # Files outside of root are put in _parent directories
+    parts = ["_parent" if part == os.pardir else part for part in relative.parts]
+    return Path(*parts).with_suffix(suffix)
+
+
+def output_paths(sources, root, suffix):
+    """
+    Return a dict of source file to the path of its output (see
+    output_path()), raising ValueError if two sources have the same
+    output, such as x.bean and x.beancount
+    """
+
+    paths = {}
+    sources_by_path = {}
+    for source in sources:
+        path = output_path(source, root, suffix)
+        other = sources_by_path.setdefault(path, source)
+        if other != source:
+            raise ValueError(f"{other} and {source} would both be converted to {path}")
+        paths[source] = path
+    return paths
+
+
+def group_entries(entries, sources, main):
+    """
+    Return a dict of source file to the entries from that file
+
+    Entries which don't come from one of the sources, such as entries
+    generated by plugins, are put with the ones of the main file.
+    """
+
+    groups = {source: [] for source in sources}
+    for entry in entries:
+        filename = (entry.meta or {}).get("filename")
+        groups.get(filename, groups[main]).append(entry)
+    return groups
+
+
+def source_stamp(source, since):
+    """
+    Return the modification time and size of source, or None if it can't
+    be read or may have been modified after it was loaded at since
+    """
+
+    try:
+        stat = os.stat(source)
+    except OSError:
+        return None
+    if stat.st_mtime >= since - MTIME_MARGIN:
+        return None
+    return f"{stat.st_mtime_ns} {stat.st_size}"
+
+
+def from_elsewhere(entry, source):
+    """
+    Return whether the output of entry can depend on other files than
+    source: entries added by plugins, padding, whose amount depends on
+    other transactions, and transactions with costs, which can be booked
+    from other files
+    """
+
+    if entry.meta.get("filename") != source:
+        return True
+    if getattr(entry, "flag", None) == flags.FLAG_PADDING:
+        return True
+    return any(posting.cost for posting in getattr(entry, "postings", ()))
+
+
+def digest(context, source, entries, includes, since):
+    """
+    Return a digest of everything the output of the entries of source
+    depends on, or None if source may have changed since it was loaded
+
+    Instead of the entries themselves, which cost about as much to hash
+    as to render, the modification time and size of source are used,
+    with only the entries which can depend on other files.
+    """
+
+    stamp = source_stamp(source, since)
+    if stamp is None:
+        return None
+    sha = hashlib.sha256(f"{context}\n{source} {stamp}\n".encode("utf-8"))
+    for entry in entries:
+        if from_elsewhere(entry, source):
+            sha.update(f"{canonical(entry)}\n".encode("utf-8"))
+    for include in includes:
+        sha.update(f"include {include}\n".encode("utf-8"))
+    return sha.hexdigest()
+
+
+def read_manifest(output_dir):
+    """
+    Return the manifest of a previous conversion to output_dir
+    """
+
+    try:
+        with open(output_dir / MANIFEST) as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return {}
+
+
+def convert_tree(file, output_dir, output_format="ledger", config={}):
+    """
+    Convert beancount file to output_dir, with one output file for
+    each source file.
+
+    The output of the main file includes the outputs of the files it
+    includes, directly or not.  Since ledger reads the outputs in the
+    order of the includes rather than by date, padding is written with
+    the amounts computed by beancount instead of balance assignments.
+    Outputs whose source file and entries didn't change since the last
+    conversion are not written again (see digest()).  Raises ValueError
+    if two source files would be converted to the same output.  Returns
+    a tuple of the list of written outputs and the list of all outputs.
+    """
+
+    main = os.path.abspath(file)
+    root = os.path.dirname(main)
+    output_dir = Path(output_dir)
+    suffix = SUFFIXES[output_format]
+
+    loaded = time.time()
+    entries, _, options_map = loader.load_file(main)
+    sources = [main] + [s for s in options_map["include"] if s != main]
+    groups = group_entries(entries, sources, main)
+    paths = output_paths(sources, root, suffix)
+    # The loader doesn't keep the order of includes, so outputs are
+    # included in the order of their first entry
+    included = sorted(
+        (source for source in sources[1:] if groups[source]),
+        key=lambda source: (groups[source][0].date, paths[source]),
+    )
+    includes = [paths[source].as_posix() for source in included]
+
+    dcontext = build_dcontext(entries)
+    printer = get_printer(output_format, dcontext, config)
+    printer.prepare = functools.partial(
+        prepare_transaction, dformat=printer.dformat, assignments=False
+    )
+    context = RenderCache.context(output_format, dcontext, config)
+    manifest = read_manifest(output_dir)
+    new_manifest = {}
+    written = []
+    for source in sources:
+        source_includes = includes if source == main else []
+        if not groups[source] and not source_includes and source != main:
+            continue
+        path = paths[source]
+        key = path.as_posix()
+        new_manifest[key] = digest(
+            context, source, groups[source], source_includes, loaded
+        )
+        if (
+            new_manifest[key] is not None
+            and manifest.get(key) == new_manifest[key]
+            and (output_dir / path).exists()
+        ):
+            continue
+
+        (output_dir / path).parent.mkdir(parents=True, exist_ok=True)
+        with atomic_open(output_dir / path) as stream:
+            for include in source_includes:
+                stream.write(f"include {include}\n")
+            if source_includes and groups[source]:
+                stream.write("\n")
+            if groups[source]:
+                stream.write(printer.render_all(groups[source]))
+                stream.write("\n")
+        written.append(path)
+
+    # Remove outputs of files which are no longer included
+    for key in manifest.keys() - new_manifest.keys():
+        try:
+            os.unlink(output_dir / key)
+        except FileNotFoundError:
+            pass
+
+    with atomic_open(output_dir / MANIFEST) as stream:
+        json.dump(new_manifest, stream, indent=2, sort_keys=True)
+        stream.write("\n")
+    return written, sorted(Path(key) for key in new_manifest)
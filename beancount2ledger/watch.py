@@ -0,0 +1,279 @@
+"""
+Conversion of books again whenever they change
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import collections
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from . import convert_to
+from .cache import RenderCache
+from .output import atomic_open
+from .server import Books, POLL_INTERVAL
+
+# Seconds to wait after a change for more changes, e.g. of editors
+# writing a backup file before the file itself
+SETTLE_TIME = 0.1
+
+# inotify events signalling that a file in a directory changed
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_EVENTS = (
+    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+
+# Header of an inotify event: watch descriptor, mask, cookie, name length
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def load_libc():
+    """
+    Return the C library if it supports inotify, or None
+    """
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class InotifyWatcher:
+    """
+    Wait for changes to files with inotify.
+
+    The directories of the files are watched rather than the files
+    themselves, so files replaced by editors are noticed too.
+    """
+
+    def __init__(self, libc, files):
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.names = {}
+        try:
+            for file in files:
+                directory, name = os.path.split(file)
+                wd = libc.inotify_add_watch(
+                    self.fd, os.fsencode(directory or "."), IN_EVENTS
+                )
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), f"cannot watch {directory}")
+                self.names.setdefault(wd, set()).add(os.fsencode(name))
+        except OSError:
+            self.close()
+            raise
+
+    def wait(self):
+        """
+        Wait until one of the files changes
+        """
+
+        while True:
+            select.select([self.fd], [], [])
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, _, __, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if name in self.names.get(wd, ()):
+                    return
+
+    def close(self):
+        """
+        Stop watching
+        """
+
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Wait for changes to books by checking the modification time of
+    their files at regular intervals
+    """
+
+    def __init__(self, books, interval=POLL_INTERVAL):
+        self.books = books
+        self.interval = interval
+
+    def wait(self):
+        """
+        Wait until one of the files of the books changes
+        """
+
+        while not self.books.changed():
+            time.sleep(self.interval)
+
+    def close(self):
+        """
+        Stop watching
+        """
+
+
+def wait_for_change(books, interval=POLL_INTERVAL, libc=None):
+    """
+    Wait until the file of books or one of the files it includes changes
+
+    inotify is used if libc supports it, otherwise files are polled
+    every interval seconds.
+    """
+
+    try:
+        watcher = InotifyWatcher(libc, books.mtimes) if libc else None
+    except OSError:
+        watcher = None
+    if watcher is None:
+        watcher = PollingWatcher(books, interval)
+    try:
+        # Files may have changed before the watches were set up
+        if not books.changed():
+            watcher.wait()
+    finally:
+        watcher.close()
+    time.sleep(SETTLE_TIME)
+
+
+def cost_numbers(entry):
+    """
+    Return the numbers of the costs of the postings of entry as text
+    """
+
+    return [
+        str(posting.cost.number)
+        for posting in getattr(entry, "postings", ())
+        if posting.cost
+    ]
+
+
+class IncrementalCache:
+    """
+    Cache of the entries rendered by the last conversion of books.
+
+    The text of an entry is reused if the entry at the same position
+    (file, line and type) in the last conversion is equal to it, and its
+    file wasn't modified since.  Comparing entries is much cheaper than
+    hashing them, and catches what the loader or plugins fill in from
+    other entries, such as metadata set with pushmeta and booked costs.
+    But numbers are compared by value, so 1.0 and 1.00 are equal while
+    they're rendered differently: that's why the numbers of costs, which
+    can be booked from other files, are compared as text too, and the
+    entries of modified files, and of no file, such as the ones added by
+    plugins, are always rendered again.
+    """
+
+    def __init__(self, books):
+        self.books = books
+        self.context = None
+        self.texts = {}
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def render(self, entries, render, output_format, dcontext, config):
+        """
+        Yield the text of entries, taken from the last conversion or
+        rendered by calling render on the list of entries which changed
+        """
+
+        context = RenderCache.context(output_format, dcontext, config)
+        cached = self.texts if context == self.context else {}
+        mtimes = self.books.mtimes
+        seen = collections.Counter()
+        keys = []
+        reused = []
+        misses = []
+        for entry in entries:
+            filename = entry.meta.get("filename")
+            position = (filename, entry.meta.get("lineno"), type(entry).__name__)
+            seen[position] += 1
+            key = position + (seen[position], mtimes.get(filename))
+            keys.append(key)
+            previous = cached.get(key)
+            reused.append(
+                key[-1] is not None
+                and previous is not None
+                and previous[0] == entry
+                and cost_numbers(previous[0]) == cost_numbers(entry)
+            )
+            if not reused[-1]:
+                misses.append(entry)
+        self.hits += len(entries) - len(misses)
+        self.misses += len(misses)
+
+        rendered = render(misses)
+        texts = {}
+        for entry, key, reuse in zip(entries, keys, reused):
+            text = cached[key][1] if reuse else next(rendered)
+            texts[key] = (entry, text)
+            yield text
+        self.evicted += len(cached.keys() - texts.keys())
+        self.context = context
+        self.texts = texts
+
+    def stats(self):
+        """
+        Return a dict of cache statistics
+        """
+
+        return {"hits": self.hits, "misses": self.misses, "evicted": self.evicted}
+
+
+def write(entries, output, output_format, dcontext, config, cache):
+    """
+    Write the conversion of entries to output and report what was
+    rendered
+    """
+
+    hits, misses = cache.hits, cache.misses
+    with atomic_open(output) as stream:
+        convert_to(entries, stream, output_format, dcontext, config, cache=cache)
+        stream.write("\n")
+    print(
+        f"wrote {output}: {len(entries)} entries, "
+        f"{cache.misses - misses} rendered, {cache.hits - hits} unchanged",
+        file=sys.stderr,
+    )
+
+
+def watch(file, output, output_format="ledger", config={}, interval=POLL_INTERVAL):
+    """
+    Convert file to output, and convert it again whenever it or one of
+    the files it includes changes, until interrupted
+
+    Only entries which changed since the last conversion are rendered
+    again (see IncrementalCache).
+    """
+
+    libc = load_libc()
+    books = Books(file)
+    cache = IncrementalCache(books)
+    generation = None
+    try:
+        while True:
+            new_generation, entries, dcontext = books.refresh()
+            if new_generation != generation:
+                generation = new_generation
+                write(entries, output, output_format, dcontext, config, cache)
+            wait_for_change(books, interval, libc)
+    except KeyboardInterrupt:
+        pass
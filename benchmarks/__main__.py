@@ -0,0 +1,13 @@
+"""
+Run the benchmark suite
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+from .conversion import main
+
+main()
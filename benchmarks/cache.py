@@ -0,0 +1,74 @@
+"""
+Benchmark converting with the render cache
+
+Run with: python -m benchmarks.cache
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import argparse
+import os
+import tempfile
+import time
+
+from beancount import loader
+
+import beancount2ledger
+from beancount2ledger.cache import RenderCache
+
+from .generate import generate_ledger
+
+
+def timed(function, *args):
+    """
+    Return the time taken to call function
+    """
+
+    begin = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - begin
+
+
+def main():
+    """
+    Time a conversion without cache, with an empty cache and with a
+    cache holding all entries
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        books = os.path.join(tmpdir, "books.beancount")
+        with open(books, "w") as stream:
+            stream.write(generate_ledger(args.entries))
+        # Files changed just before the cache was opened aren't cached
+        mtime = time.time() - 60
+        os.utime(books, (mtime, mtime))
+        entries, _, __ = loader.load_file(books)
+        dcontext = beancount2ledger.build_dcontext(entries)
+
+        def convert(cache=None):
+            beancount2ledger.convert(entries, dcontext=dcontext, cache=cache)
+
+        path = os.path.join(tmpdir, "cache.sqlite")
+        plain = timed(convert)
+        with RenderCache(path) as cache:
+            cold = timed(convert, cache)
+        with RenderCache(path) as cache:
+            warm = timed(convert, cache)
+            hits = cache.hits
+
+    print(f"entries:           {len(entries)}")
+    print(f"no cache (s):      {plain:.3f}")
+    print(f"cold cache (s):    {cold:.3f}")
+    print(f"warm cache (s):    {warm:.3f} ({hits} hits)")
+
+
+if __name__ == "__main__":
+    main()
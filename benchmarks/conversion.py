@@ -0,0 +1,180 @@
+"""
+Benchmark the phases of the conversion of synthetic ledgers
+
+Run with: python -m benchmarks
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+from beancount import loader
+
+import beancount2ledger
+
+from .generate import generate_ledger, mapping_config
+
+
+def traced_peak(func, *args):
+    """
+    Return the peak of the memory allocated by Python while calling
+    func, in MiB, not counting what was allocated before
+    """
+
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def timed(results, phase, num_entries, memory, func, *args):
+    """
+    Call func and record its wall and CPU time in results, and if memory
+    is true, the peak memory allocated by calling it again
+    """
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    value = func(*args)
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    # Tracing slows down Python, so the peak is measured separately
+    peak = traced_peak(func, *args) if memory else None
+    results.append(
+        {
+            "phase": phase,
+            "entries": num_entries,
+            "wall": wall,
+            "cpu": cpu,
+            "entries_per_sec": num_entries / wall if wall else None,
+            "peak_mib": peak,
+        }
+    )
+    return value
+
+
+def render(entries, output_format, dcontext, config):
+    """
+    Render entries and discard the output
+    """
+
+    for _ in beancount2ledger.convert_iter(entries, output_format, dcontext, config):
+        pass
+
+
+def run(size, args):
+    """
+    Benchmark the conversion of a ledger of size entries
+    """
+
+    results = []
+    text = generate_ledger(
+        size, num_accounts=args.accounts, num_commodities=args.commodities
+    )
+    config = mapping_config(args.accounts, args.commodities)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, "benchmark.beancount")
+        with open(filename, "w", encoding="utf-8") as beanfile:
+            beanfile.write(text)
+        del text
+        entries, _, __ = timed(
+            results, "load", size, args.memory, loader.load_file, filename
+        )
+    num_entries = len(entries)
+    dcontext = timed(
+        results,
+        "dcontext",
+        num_entries,
+        args.memory,
+        beancount2ledger.build_dcontext,
+        entries,
+    )
+    for output_format in args.formats:
+        timed(
+            results,
+            f"render {output_format}",
+            num_entries,
+            args.memory,
+            render,
+            entries,
+            output_format,
+            dcontext,
+            {},
+        )
+        timed(
+            results,
+            f"render+map {output_format}",
+            num_entries,
+            args.memory,
+            render,
+            entries,
+            output_format,
+            dcontext,
+            config,
+        )
+    for result in results:
+        result["size"] = size
+    return results
+
+
+def main():
+    """
+    Run the benchmark suite
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10000],
+        help="number of generated entries (e.g. 10000 100000 1000000)",
+    )
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--commodities", type=int, default=50)
+    parser.add_argument(
+        "--formats",
+        nargs="+",
+        choices=("ledger", "hledger"),
+        default=["ledger", "hledger"],
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="also measure the peak memory of each phase, running it again",
+    )
+    parser.add_argument("--json", metavar="FILE", help="write results to FILE")
+    args = parser.parse_args()
+
+    results = []
+    print(
+        f"{'size':>8} {'phase':<18} {'wall (s)':>9} {'cpu (s)':>9}"
+        f" {'entries/s':>10} {'peak MiB':>9}"
+    )
+    for size in args.sizes:
+        for result in run(size, args):
+            results.append(result)
+            peak = result["peak_mib"]
+            print(
+                f"{size:>8} {result['phase']:<18} {result['wall']:>9.3f}"
+                f" {result['cpu']:>9.3f} {result['entries_per_sec'] or 0:>10.0f}"
+                f" {'-' if peak is None else f'{peak:.1f}':>9}"
+            )
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
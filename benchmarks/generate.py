@@ -0,0 +1,152 @@
+"""
+Generate synthetic beancount ledgers for benchmarks
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import datetime
+import random
+
+
+def account_names(num_accounts):
+    """
+    Return a list of num_accounts account names
+    """
+
+    roots = ("Assets", "Liabilities", "Income", "Expenses", "Equity")
+    return [
+        f"{roots[i % len(roots)]}:Group{i // 100:03d}:Account{i:05d}"
+        for i in range(num_accounts)
+    ]
+
+
+def generate(num_entries, num_accounts=100, seed=0):
+    """
+    Generate a beancount ledger with num_entries transactions between
+    num_accounts accounts
+    """
+
+    rnd = random.Random(seed)
+    accounts = account_names(num_accounts)
+    start = datetime.date(2000, 1, 1)
+    lines = [f"{start} open {account}" for account in accounts]
+    lines.append("")
+    for i in range(num_entries):
+        date = start + datetime.timedelta(days=i * 3650 // max(1, num_entries))
+        src, dest = rnd.sample(accounts, 2)
+        number = rnd.randint(1, 100000) / 100
+        lines.append(f'{date} * "Payee {i % 97}" "Transaction {i}"')
+        lines.append(f"  {dest}  {number:.2f} EUR")
+        lines.append(f"  {src}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def generate_wide(num_entries, width, seed=0):
+    """
+    Generate a beancount ledger with num_entries transactions of width
+    postings each, half of them held at cost
+    """
+
+    rnd = random.Random(seed)
+    accounts = account_names(width)
+    start = datetime.date(2000, 1, 1)
+    lines = [f"{start} open {account}" for account in accounts]
+    lines.append(f"{start} open Assets:Cash")
+    lines.append("")
+    for i in range(num_entries):
+        date = start + datetime.timedelta(days=i)
+        lines.append(f'{date} * "Allocation {i}"')
+        total = 0
+        for j, account in enumerate(accounts):
+            number = rnd.randint(1, 100000) / 100
+            if j % 2:
+                lines.append(f"  {account}  1 FUND{j} {{{number:.2f} EUR}}")
+            else:
+                lines.append(f"  {account}  {number:.2f} EUR")
+            total += number
+        lines.append(f"  Assets:Cash  {-total:.2f} EUR")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def generate_ledger(
+    num_entries,
+    num_accounts=1000,
+    num_commodities=50,
+    wide_every=100,
+    width=50,
+    meta_every=10,
+    num_meta=10,
+    price_ratio=0.3,
+    seed=0,
+):
+    """
+    Generate a beancount ledger of about num_entries directives which
+    mixes simple transactions, wide transactions (one in wide_every, with
+    width postings), transactions with num_meta metadata (one in
+    meta_every) and a share of price_ratio price directives
+    """
+
+    rnd = random.Random(seed)
+    accounts = account_names(num_accounts)
+    commodities = commodity_names(num_commodities)
+    start = datetime.date(1990, 1, 1)
+    lines = [f"{start} open {account}" for account in accounts]
+    lines.append(f"{start} open Assets:Investments")
+    lines.append("")
+    for i in range(num_entries):
+        date = start + datetime.timedelta(days=i * 365 * 30 // max(1, num_entries))
+        if rnd.random() < price_ratio:
+            commodity = rnd.choice(commodities)
+            number = rnd.randint(100, 1000000) / 100
+            lines.append(f"{date} price {commodity} {number:.2f} EUR")
+            continue
+        lines.append(f'{date} * "Payee {i % 97}" "Transaction {i}"')
+        if meta_every and i % meta_every == 0:
+            for j in range(num_meta):
+                lines.append(f'  key{j}: "value {i} {j}"')
+        if wide_every and i % wide_every == 0:
+            postings = rnd.sample(accounts, min(width, len(accounts)))
+        else:
+            postings = rnd.sample(accounts, 1)
+        for account in postings:
+            number = rnd.randint(1, 100000) / 100
+            lines.append(f"  {account}  {number:.2f} EUR")
+        if rnd.random() < 0.1:
+            commodity = rnd.choice(commodities)
+            number = rnd.randint(100, 100000) / 100
+            lines.append(f"  Assets:Investments  1 {commodity} {{{number:.2f} EUR}}")
+        lines.append(f"  {rnd.choice(accounts)}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def commodity_names(num_commodities):
+    """
+    Return a list of num_commodities commodity names
+    """
+
+    return [f"STOCK{i:04d}" for i in range(num_commodities)]
+
+
+def mapping_config(num_accounts=1000, num_commodities=50):
+    """
+    Return a config mapping all accounts and commodities of
+    generate_ledger()
+    """
+
+    return {
+        "account_map": {
+            account: account.replace(":Group", ":Mapped Group")
+            for account in account_names(num_accounts)
+        },
+        "currency_map": {
+            commodity: commodity.replace("STOCK", "S")
+            for commodity in commodity_names(num_commodities)
+        },
+    }
@@ -0,0 +1,58 @@
+"""
+Benchmark the mapping of accounts and currencies
+
+Accounts and currencies are mapped by the printers while rendering, so
+the time taken shouldn't depend on the size of the mappings.
+
+Run with: python -m benchmarks.mapping
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import argparse
+import time
+
+from beancount import loader
+
+import beancount2ledger
+
+from .generate import account_names, generate
+
+
+def main():
+    """
+    Time conversion with account maps of several sizes
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=2000)
+    parser.add_argument("--accounts", type=int, default=5000)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[0, 10, 100, 1000, 5000]
+    )
+    args = parser.parse_args()
+
+    entries, _, __ = loader.load_string(generate(args.entries, args.accounts))
+    dcontext = beancount2ledger.build_dcontext(entries)
+    accounts = account_names(args.accounts)
+
+    print(f"{'keys':>8} {'render (s)':>14}")
+    for size in args.sizes:
+        config = {
+            "account_map": {
+                account: f"Mapped:{account}" for account in accounts[:size]
+            },
+            "currency_map": {"EUR": "€"} if size else {},
+        }
+        begin = time.perf_counter()
+        beancount2ledger.convert(entries, dcontext=dcontext, config=config)
+        render_time = time.perf_counter() - begin
+        print(f"{size:>8} {render_time:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Benchmark the detection of residuals
+
+Run with: python -m benchmarks.residual
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import argparse
+import time
+
+from beancount import loader
+from beancount.core import data
+from beancount.core import interpolate
+
+from beancount2ledger.common import ROUNDING_ACCOUNT, fill_residual_posting
+
+from .generate import generate
+
+
+def main():
+    """
+    Time filling residual postings with and without the cheap check
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=100000)
+    args = parser.parse_args()
+
+    entries, _, __ = loader.load_string(generate(args.entries))
+    txns = list(data.filter_txns(entries))
+
+    begin = time.perf_counter()
+    for entry in txns:
+        interpolate.fill_residual_posting(entry, ROUNDING_ACCOUNT)
+    inventory_time = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    for entry in txns:
+        fill_residual_posting(entry)
+    check_time = time.perf_counter() - begin
+
+    print(f"transactions:      {len(txns)}")
+    print(f"inventory (s):     {inventory_time:.3f}")
+    print(f"cheap check (s):   {check_time:.3f}")
+
+
+if __name__ == "__main__":
+    main()
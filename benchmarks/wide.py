@@ -0,0 +1,47 @@
+"""
+Benchmark the conversion of wide transactions
+
+Run with: python -m benchmarks.wide
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import argparse
+import time
+
+from beancount import loader
+
+import beancount2ledger
+
+from .generate import generate_wide
+
+
+def main():
+    """
+    Time the conversion of transactions with a growing number of postings
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--entries", type=int, default=20)
+    parser.add_argument("--widths", type=int, nargs="+", default=[10, 100, 1000])
+    args = parser.parse_args()
+
+    print(f"{'postings':>8} {'ledger (s)':>14} {'hledger (s)':>14} {'postings/s':>14}")
+    for width in args.widths:
+        entries, _, __ = loader.load_string(generate_wide(args.entries, width))
+        dcontext = beancount2ledger.build_dcontext(entries)
+        times = []
+        for output_format in ("ledger", "hledger"):
+            begin = time.perf_counter()
+            beancount2ledger.convert(entries, output_format, dcontext=dcontext)
+            times.append(time.perf_counter() - begin)
+        rate = args.entries * (width + 1) / times[0]
+        print(f"{width:>8} {times[0]:>14.3f} {times[1]:>14.3f} {rate:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,529 @@
+"""
+Tests for the conversion API
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import concurrent.futures
+import datetime
+import io
+import os
+import pstats
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+from unittest import mock
+
+from beancount.utils import test_utils
+from beancount import loader
+from beancount.core import data
+from beancount.scripts import example
+
+import beancount2ledger
+from beancount2ledger.common import prepare_transaction
+from beancount2ledger.cache import RenderCache
+from beancount2ledger.profiling import profile
+from beancount2ledger.stats import ConversionStats
+
+
+class TestStreamingConversion(test_utils.TestCase):
+    """
+    Test writing converted output to a stream
+    """
+
+    @loader.load_doc()
+    def setUp(self, entries, _, __):
+        """
+        2020-01-01 open Assets:Test
+        2020-01-01 open Assets:Other
+
+        2020-01-02 price HOOL 500.00 EUR
+
+        2020-01-02 balance Assets:Test 0.00 EUR
+
+        2020-11-13 * "Test"
+          Assets:Test        1000.00 EUR
+          Assets:Other
+
+        2020-11-14 * "Test"
+          Assets:Test        -1000.00 EUR
+          Assets:Other
+        """
+        self.entries = entries
+
+    def test_convert_iter(self):
+        """
+        Test that convert_iter() yields one string per entry
+        """
+
+        result = list(beancount2ledger.convert_iter(self.entries))
+        self.assertEqual(len(self.entries), len(result))
+        self.assertEqual(beancount2ledger.convert(self.entries), "\n".join(result))
+
+    def test_convert_to(self):
+        """
+        Test that the streamed output is identical to convert()
+        """
+
+        for output_format in ("ledger", "hledger"):
+            expected = beancount2ledger.convert(self.entries, output_format)
+            for chunk_size in (1, 10, 1000):
+                stream = io.StringIO()
+                written = beancount2ledger.convert_to(
+                    self.entries, stream, output_format, chunk_size=chunk_size
+                )
+                self.assertEqual(expected, stream.getvalue())
+                self.assertEqual(len(expected), written)
+
+    def test_convert_to_binary(self):
+        """
+        Test writing to a binary stream
+        """
+
+        config = {"currency_map": {"EUR": "€"}}
+        expected = beancount2ledger.convert(self.entries, config=config)
+        stream = io.BytesIO()
+        beancount2ledger.convert_to(self.entries, stream, config=config)
+        self.assertEqual(expected.encode("utf-8"), stream.getvalue())
+
+    def test_price_stream(self):
+        """
+        Test writing prices to a separate price database
+        """
+
+        prices = [entry for entry in self.entries if isinstance(entry, data.Price)]
+        others = [entry for entry in self.entries if entry not in prices]
+        for chunk_size in (1, 1000):
+            stream = io.StringIO()
+            price_stream = io.StringIO()
+            written = beancount2ledger.convert_to(
+                self.entries, stream, chunk_size=chunk_size, price_stream=price_stream
+            )
+            dcontext = beancount2ledger.build_dcontext(self.entries)
+            self.assertEqual(
+                beancount2ledger.convert(others, dcontext=dcontext), stream.getvalue()
+            )
+            self.assertEqual(
+                "".join(beancount2ledger.convert_iter(prices, dcontext=dcontext)),
+                price_stream.getvalue(),
+            )
+            self.assertEqual(len(stream.getvalue() + price_stream.getvalue()), written)
+
+    def test_convert_to_many(self):
+        """
+        Test writing several formats in one pass
+        """
+
+        formats = ("ledger", "hledger")
+        streams = [io.StringIO() for _ in formats]
+        prepare = mock.Mock(wraps=prepare_transaction)
+        with mock.patch("beancount2ledger.prepare_transaction", prepare):
+            written = beancount2ledger.convert_to_many(
+                self.entries, list(zip(formats, streams)), chunk_size=10
+            )
+        # Each transaction is prepared once for both formats
+        self.assertEqual(2, prepare.call_count)
+        for output_format, stream, length in zip(formats, streams, written):
+            expected = beancount2ledger.convert(self.entries, output_format)
+            self.assertEqual(expected, stream.getvalue())
+            self.assertEqual(len(expected), length)
+
+
+class TestParallelConversion(test_utils.TestCase):
+    """
+    Test rendering entries in several processes or threads
+    """
+
+    @loader.load_doc()
+    def test_jobs(self, entries, _, __):
+        """
+        2020-01-01 open Assets:Test
+        2020-01-01 open Assets:Other
+
+        2020-01-02 price HOOL 500.00 EUR
+
+        2020-11-13 * "Test"
+          Assets:Test        1000.00 EUR
+          Assets:Other
+
+        2020-11-14 * "Test"
+          Assets:Test        -1000.001 EUR
+          Assets:Other        1000.00 EUR
+        """
+        config = {"account_map": {"Assets:Test": "Assets:My Test"}}
+        chunk_size = beancount2ledger.JOB_CHUNK_SIZE
+        beancount2ledger.JOB_CHUNK_SIZE = 2
+        try:
+            for output_format in ("ledger", "hledger"):
+                expected = beancount2ledger.convert(
+                    entries, output_format, config=config
+                )
+                result = beancount2ledger.convert(
+                    entries, output_format, config=config, jobs=2
+                )
+                self.assertEqual(expected, result)
+
+                # Entries are rendered in this process while another
+                # parallel conversion is in progress
+                with beancount2ledger._worker_lock:
+                    result = beancount2ledger.convert(
+                        entries, output_format, config=config, jobs=2
+                    )
+                self.assertEqual(expected, result)
+        finally:
+            beancount2ledger.JOB_CHUNK_SIZE = chunk_size
+
+    def test_threads(self):
+        """
+        Test that threads rendering with one printer give the same output
+        """
+
+        text = io.StringIO()
+        example.write_example_file(
+            datetime.date(1980, 1, 1),
+            datetime.date(2012, 1, 1),
+            datetime.date(2013, 1, 1),
+            reformat=False,
+            file=text,
+        )
+        entries, _, __ = loader.load_string(text.getvalue())
+        config = {"account_map": {"Assets:US:BofA:Checking": "Assets:Checking"}}
+        switch_interval = sys.getswitchinterval()
+        # Switch threads often so rendering of entries is interleaved
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+        for output_format in ("ledger", "hledger"):
+            expected = beancount2ledger.convert(entries, output_format, config=config)
+            with mock.patch("beancount2ledger._free_threaded", return_value=True):
+                with mock.patch("beancount2ledger.JOB_CHUNK_SIZE", 50):
+                    stats = ConversionStats()
+                    result = beancount2ledger.convert(
+                        entries, output_format, config=config, jobs=4, stats=stats
+                    )
+            self.assertEqual(expected, result)
+            self.assertEqual(len(entries), stats.entries)
+
+            printer = beancount2ledger.get_printer(
+                output_format, beancount2ledger.build_dcontext(entries), config
+            )
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(printer, entries * 4))
+            self.assertEqual(expected, "\n".join(results[: len(entries)]))
+            self.assertEqual(results[: len(entries)] * 4, results)
+
+
+class TestRenderCache(test_utils.TestCase):
+    """
+    Test reusing rendered entries from a cache
+    """
+
+    ledger = """
+        2020-01-01 open Assets:Test
+        2020-01-01 open Assets:Other
+
+        2020-11-13 * "Test"
+          Assets:Test        1000.00 EUR
+          Assets:Other
+
+        2020-11-14 * "Test" #tag1 #tag2
+          Assets:Test        -1000.00 EUR
+          Assets:Other
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "cache.sqlite")
+        self.books = os.path.join(tmpdir.name, "books.beancount")
+
+    def convert(self, text, cache, output_format="ledger", age=60):
+        """
+        Write text to a file last modified age seconds ago, convert it
+        with cache and return the output
+        """
+
+        with open(self.books, "w") as stream:
+            stream.write(textwrap.dedent(text))
+        mtime = time.time() - age
+        os.utime(self.books, (mtime, mtime))
+        entries, _, __ = loader.load_file(self.books)
+        return beancount2ledger.convert(entries, output_format, cache=cache)
+
+    def test_cache(self):
+        """
+        Test hits and misses and that cached output is identical
+        """
+
+        with RenderCache(self.path) as cache:
+            expected = self.convert(self.ledger, cache)
+            self.assertEqual({"hits": 0, "misses": 4, "evicted": 0}, cache.stats())
+        with RenderCache(self.path) as cache:
+            self.assertEqual(expected, self.convert(self.ledger, cache))
+            self.assertEqual({"hits": 4, "misses": 0, "evicted": 0}, cache.stats())
+
+        # Moving entries around in the file doesn't invalidate them
+        # but changing them does.
+        with RenderCache(self.path) as cache:
+            text = "\n\n" + self.ledger.replace("-1000.00", "-1000.01")
+            self.assertIn("-1000.01 EUR", self.convert(text, cache))
+            self.assertEqual({"hits": 3, "misses": 1, "evicted": 0}, cache.stats())
+
+        # The output format is part of the key
+        with RenderCache(self.path) as cache:
+            self.convert(self.ledger, cache, "hledger")
+            self.assertEqual({"hits": 0, "misses": 4, "evicted": 0}, cache.stats())
+
+    def test_uncached(self):
+        """
+        Test that entries which can't be keyed by their source are
+        rendered every time
+        """
+
+        # The file may have changed after it was loaded
+        with RenderCache(self.path) as cache:
+            self.convert(self.ledger, cache, age=0)
+            self.assertEqual({"hits": 0, "misses": 4, "evicted": 0}, cache.stats())
+
+    def test_booked(self):
+        """
+        Test that costs booked from other entries are part of the key
+        """
+
+        ledger = """
+            2020-01-01 open Assets:Test
+            2020-01-01 open Assets:Other
+
+            2020-11-13 * "Buy"
+              Assets:Test        1 HOOL {100.00 EUR}
+              Assets:Other
+
+            2020-11-14 * "Sell"
+              Assets:Test        -1 HOOL {}
+              Assets:Other
+        """
+        with RenderCache(self.path) as cache:
+            self.convert(ledger, cache)
+        with RenderCache(self.path) as cache:
+            output = self.convert(ledger.replace("{100.00", "{200.00"), cache)
+            self.assertEqual({"hits": 2, "misses": 2, "evicted": 0}, cache.stats())
+            self.assertNotIn("100.00", output)
+
+    def test_derived(self):
+        """
+        Test that parts of entries which don't come from their source
+        text are part of the key
+        """
+
+        ledger = """
+            2020-01-01 open Assets:Test
+            2020-01-01 open Assets:Other
+
+            pushmeta project: "alpha"
+
+            2020-11-13 * "Test"
+              Assets:Test        1000.00 EUR
+              Assets:Other
+
+            2020-11-14 pad Assets:Test Assets:Other
+            2020-11-15 balance Assets:Test 1500.00 EUR
+        """
+        with RenderCache(self.path) as cache:
+            self.convert(ledger, cache)
+        with RenderCache(self.path) as cache:
+            text = ledger.replace("alpha", "beta").replace("1000.00", "2000.00")
+            output = self.convert(text, cache)
+        entries, _, __ = loader.load_file(self.books)
+        self.assertEqual(beancount2ledger.convert(entries), output)
+        self.assertIn("; project: beta", output)
+
+    def test_evict(self):
+        """
+        Test that the cache doesn't grow beyond its maximum size
+        """
+
+        with RenderCache(self.path, max_entries=3) as cache:
+            self.convert(self.ledger, cache)
+        self.assertEqual(1, cache.stats()["evicted"])
+        with RenderCache(self.path, max_entries=3) as cache:
+            self.convert(self.ledger, cache)
+            self.assertEqual(3, cache.stats()["hits"])
+
+
+class TestConversionStats(test_utils.TestCase):
+    """
+    Test collecting timings and counters of a conversion
+    """
+
+    @loader.load_doc()
+    def test_stats(self, entries, _, __):
+        """
+        2020-01-01 open Assets:Test
+        2020-01-01 open Assets:Other
+
+        2020-11-13 * "Test"
+          Assets:Test        1000.00 EUR
+          Assets:Other
+        """
+        # Non-ASCII names are counted in bytes
+        config = {"account_map": {"Assets:Test": "Assets:Mý Test"}}
+        stats = ConversionStats()
+        output = beancount2ledger.convert(entries, config=config, stats=stats)
+        self.assertEqual(output, beancount2ledger.convert(entries, config=config))
+        self.assertEqual(["dcontext", "render"], sorted(stats.phases))
+        self.assertEqual(2, stats.directives["Open"]["count"])
+        self.assertEqual(1, stats.directives["Transaction"]["count"])
+        self.assertEqual(3, stats.entries)
+        self.assertEqual(len(output.encode("utf-8")), stats.bytes)
+        # The open and the posting of Assets:Test
+        self.assertEqual(2, stats.mappings)
+
+        stream = io.StringIO()
+        stats.report(stream)
+        self.assertIn("Transaction", stream.getvalue())
+
+    @loader.load_doc()
+    def test_stats_jobs(self, entries, _, __):
+        """
+        2020-01-01 open Assets:Test
+        2020-01-01 open Assets:Other
+
+        2020-11-13 * "Test"
+          Assets:Test        1000.00 EUR
+          Assets:Other
+
+        2020-11-14 * "Test"
+          Assets:Test        -1000.00 EUR
+          Assets:Other
+        """
+        config = {"account_map": {"Assets:Test": "Assets:My Test"}}
+        chunk_size = beancount2ledger.JOB_CHUNK_SIZE
+        beancount2ledger.JOB_CHUNK_SIZE = 2
+        try:
+            stats = ConversionStats()
+            beancount2ledger.convert(entries, config=config, jobs=2, stats=stats)
+        finally:
+            beancount2ledger.JOB_CHUNK_SIZE = chunk_size
+        self.assertEqual(4, stats.entries)
+        self.assertEqual(3, stats.mappings)
+
+        # Threads count the names they map in their own chunks
+        with mock.patch("beancount2ledger._free_threaded", return_value=True):
+            with mock.patch("beancount2ledger.JOB_CHUNK_SIZE", 1):
+                stats = ConversionStats()
+                beancount2ledger.convert(entries, config=config, jobs=2, stats=stats)
+        self.assertEqual(4, stats.entries)
+        self.assertEqual(3, stats.mappings)
+
+    @loader.load_doc()
+    def test_slowest(self, entries, _, __):
+        """
+        2020-01-01 open Assets:Test
+        2020-01-01 open Assets:Other
+
+        2020-11-13 * "Test"
+          Assets:Test        1000.00 EUR
+          Assets:Other
+
+        2020-11-14 * "Test"
+          Assets:Test        -1000.00 EUR
+          Assets:Other
+        """
+        stats = ConversionStats(slowest=2)
+        beancount2ledger.convert(entries, stats=stats)
+        slowest = stats.slowest_entries()
+        self.assertEqual(2, len(slowest))
+        self.assertGreaterEqual(slowest[0][0], slowest[1][0])
+        for seconds, location, name in slowest:
+            filename, lineno = location.rsplit(":", 1)
+            entry = next(e for e in entries if e.meta["lineno"] == int(lineno))
+            self.assertEqual(entry.meta["filename"], filename)
+            self.assertEqual(type(entry).__name__, name)
+
+        # Keeping the slowest entries of several workers
+        other = ConversionStats(slowest=2)
+        other.add_entry(entries[-1], 100.0)
+        stats.merge(other)
+        self.assertEqual(100.0, stats.slowest_entries()[0][0])
+        self.assertEqual(2, len(stats.slowest_entries()))
+
+
+class TestProfile(test_utils.TestCase):
+    """
+    Test profiling conversions
+    """
+
+    ledger = """
+        2020-01-01 open Assets:Test
+        2020-01-01 open Assets:Other
+
+        2020-11-13 * "Test"
+          Assets:Test        1000.00 EUR
+          Assets:Other
+    """
+
+    def test_pstats(self):
+        """
+        Test writing a cProfile profile
+        """
+
+        entries, _, __ = loader.load_string(self.ledger, dedent=True)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "profile.pstats")
+            with profile(path):
+                beancount2ledger.convert(entries)
+            functions = [func[2] for func in pstats.Stats(path).stats]
+        self.assertIn("convert", functions)
+
+    def test_collapsed(self):
+        """
+        Test writing collapsed stacks of the sampling profiler
+        """
+
+        entries, _, __ = loader.load_string(self.ledger, dedent=True)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "profile.collapsed")
+            with profile(path, interval=0.0001) as sampler:
+                while not sampler.samples:
+                    beancount2ledger.convert(entries)
+            with open(path) as stream:
+                lines = stream.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertIn("test_collapsed", stack)
+            self.assertGreater(int(count), 0)
+
+
+class TestLoadString(test_utils.TestCase):
+    """
+    Test loading entries from a string, as done for stdin
+    """
+
+    def test_include(self):
+        """
+        Test that includes are relative to the current directory
+        """
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(os.path.join(tmpdir, "sub"))
+            with open(os.path.join(tmpdir, "sub", "accounts.beancount"), "w") as f:
+                f.write("2020-01-01 open Assets:Test\n")
+            cwd = os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                entries, _ = beancount2ledger.load_string(
+                    'include "sub/accounts.beancount"\n'
+                )
+            finally:
+                os.chdir(cwd)
+        self.assertEqual("account Assets:Test\n", beancount2ledger.convert(entries))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+"""
+Tests for the selection of entries
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import unittest
+
+from beancount.utils import test_utils
+from beancount import loader
+
+import beancount2ledger
+from beancount2ledger.filters import DECLARATIONS, DateIndex, filter_entries
+
+
+class TestFilterEntries(test_utils.TestCase):
+    """
+    Test selecting entries by date and account
+    """
+
+    @loader.load_doc()
+    def setUp(self, entries, _, __):
+        """
+        2020-01-01 open Assets:Test
+        2020-01-01 open Assets:Other
+        2020-01-01 open Expenses:Food
+
+        2020-01-02 price HOOL 500.00 EUR
+
+        2020-01-13 * "Test"
+          Assets:Test        1000.00 EUR
+          Assets:Other
+
+        2020-02-14 * "Food"
+          Expenses:Food        10.00 EUR
+          Assets:Other
+        """
+        self.entries = entries
+
+    def test_dates(self):
+        """
+        Test that declarations before the beginning are kept
+        """
+
+        result = beancount2ledger.convert(
+            filter_entries(self.entries, "2020-01-10", "2020-02-01")
+        )
+        self.assertLines(
+            """
+            account Assets:Test
+
+            account Assets:Other
+
+            account Expenses:Food
+
+            2020-01-13 * Test
+              Assets:Test                               1000.00 EUR
+              Assets:Other
+            """,
+            result,
+        )
+
+    def test_account(self):
+        """
+        Test that entries without accounts are kept
+        """
+
+        result = filter_entries(self.entries, account="Expenses")
+        self.assertEqual(
+            ["Open", "Price", "Transaction"], [type(e).__name__ for e in result]
+        )
+        self.assertEqual("Food", result[-1].narration)
+
+    def test_invalid(self):
+        """
+        Test errors for invalid dates and regular expressions
+        """
+
+        with self.assertRaises(ValueError):
+            filter_entries(self.entries, begin="2020-13-01")
+        with self.assertRaises(ValueError):
+            filter_entries(self.entries, account="Assets:(")
+
+    def test_index(self):
+        """
+        Test that selecting with the index gives the same entries as
+        checking every entry, also for entries which aren't sorted
+        """
+
+        dates = [None, "2020-01-01", "2020-01-02", "2020-01-13", "2020-03-01"]
+        index = DateIndex(list(reversed(self.entries)))
+        for begin in dates:
+            for end in dates:
+                expected = [
+                    entry
+                    for entry in self.entries
+                    if (end is None or str(entry.date) < end)
+                    and (
+                        begin is None
+                        or str(entry.date) >= begin
+                        or isinstance(entry, DECLARATIONS)
+                    )
+                ]
+                self.assertEqual(expected, index.select(begin, end))
+
+    def test_opening(self):
+        """
+        Test summarizing entries before the beginning as opening balances
+        """
+
+        result = beancount2ledger.convert(
+            filter_entries(self.entries, "2020-02-01", opening=True)
+        )
+        expected = """
+            2020-01-31 Opening balance for 'Assets:Test' (Summarization)
+              Assets:Test 1000.00 EUR
+              Equity:Opening-Balances -1000.00 EUR
+        """
+        # Compare without the alignment of amounts
+        self.assertIn(" ".join(expected.split()), " ".join(result.split()))
+        self.assertIn("2020-02-14 * Food", result)
+        self.assertNotIn("2020-01-13", result)
+
+
+if __name__ == "__main__":
+    unittest.main()
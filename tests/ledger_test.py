@@ -9,23 +9,38 @@ Tests for ledger conversion
 
 __license__ = "GPL-2.0-or-later"
 
+import collections
 import tempfile
 import datetime
+import io
 import re
 import shutil
 import subprocess
 import unittest
+from unittest import mock
 
 from beancount.core import data
+from beancount.core import display_context
+from beancount.core import interpolate
+from beancount.core.amount import A
+from beancount.core.number import D
 from beancount.utils import test_utils
 from beancount.scripts import example
 from beancount.parser import cmptest
 from beancount import loader
 
 import beancount2ledger
+from beancount2ledger.cache import RenderCache
 from beancount2ledger.common import (
+    ROUNDING_ACCOUNT,
+    Options,
+    cost_needs_price,
+    filter_rounding_postings,
+    fill_residual_posting,
+    has_residual,
     quote_currency,
     postings_by_type,
+    prepare_transaction,
     split_currency_conversions,
 )
 
@@ -60,6 +75,21 @@ class TestLedgerUtilityFunctions(cmptest.TestCase):
         """
         self.assertEqual(expected, quote_currency(test))
 
+    def test_filter_rounding_postings(self):
+        dcontext = display_context.DisplayContext()
+        dcontext.update(D("1.00"), "USD")
+        dformat = dcontext.build()
+        postings = [
+            data.Posting(ROUNDING_ACCOUNT, A(number), None, None, None, None)
+            for number in ("0.005 USD", "-0.0051 USD", "0.01 EUR", "0 EUR")
+        ]
+        entry = data.Transaction({}, None, "*", None, "", set(), set(), postings)
+        entry = filter_rounding_postings(entry, dformat)
+        self.assertEqual(
+            [A("-0.0051 USD"), A("0.01 EUR")],
+            [posting.units for posting in entry.postings],
+        )
+
 
 class TestLedgerUtilityFunctionsOnPostings(cmptest.TestCase):
     @loader.load_doc()
@@ -83,6 +113,11 @@ class TestLedgerUtilityFunctionsOnPostings(cmptest.TestCase):
           Assets:CA:Investment:HOOL          5 HOOL {520.0 USD}
           Expenses:Commissions            9.95 USD
           Assets:CA:Investment:Cash   -2939.46 CAD @ 0.8879 USD
+
+        2014-10-04 * "Buy some stock with an automatic posting"
+          Assets:CA:Investment:HOOL          5 HOOL {500.00 USD}
+          Expenses:Commissions            9.95 USD
+          Assets:CA:Investment:Cash
         """
         self.txns = [entry for entry in entries if isinstance(entry, data.Transaction)]
 
@@ -96,6 +131,30 @@ class TestLedgerUtilityFunctionsOnPostings(cmptest.TestCase):
         postings_lists = postings_by_type(self.txns[2])
         self.assertEqual([1, 1, 1], list(map(len, postings_lists)))
 
+    def test_cost_needs_price(self):
+        self.assertTrue(cost_needs_price(self.txns[0]))
+        self.assertTrue(cost_needs_price(self.txns[2]))
+        self.assertFalse(cost_needs_price(self.txns[3]))
+
+    def test_prepare_transaction(self):
+        dformat = display_context.DEFAULT_DISPLAY_CONTEXT.build()
+        txn = prepare_transaction(self.txns[0], dformat)
+        self.assertIsNone(txn.padded)
+        self.assertTrue(txn.cost_price)
+        self.assertEqual({}, txn.meta)
+        self.assertEqual(
+            [self.txns[0].postings[i] for i in (0, 1, 2)],
+            [posting for posting, _ in txn.postings],
+        )
+        with self.assertRaises(AttributeError):
+            txn.dformat = dformat
+
+        # Only user metadata is kept, e.g. not the one of the automatic posting
+        txn = prepare_transaction(self.txns[3], dformat)
+        self.assertFalse(txn.cost_price)
+        self.assertIn("__automatic__", txn.postings[2][0].meta)
+        self.assertEqual([{}, {}, {}], [meta for _, meta in txn.postings])
+
     def test_split_currency_conversions(self):
         converted, _ = split_currency_conversions(self.txns[0])
         self.assertFalse(converted)
@@ -1014,6 +1073,29 @@ class TestLedgerConversion(test_utils.TestCase):
             result,
         )
 
+    @loader.load_doc()
+    def test_postings_without_meta(self, entries, _, ___):
+        """
+        2020-01-01 open Assets:Test
+        2020-01-01 open Assets:Other
+
+        2020-07-24 * "Generated"
+          Assets:Test        1000.00 EUR
+          Assets:Other      -1000.00 EUR
+        """
+        # Postings generated by plugins have no metadata
+        entry = entries[-1]
+        postings = [posting._replace(meta=None) for posting in entry.postings]
+        result = beancount2ledger.convert([entry._replace(postings=postings)])
+        self.assertLines(
+            r"""
+            2020-07-24 * Generated
+              Assets:Test                                                    1000.00 EUR
+              Assets:Other                                                  -1000.00 EUR
+        """,
+            result,
+        )
+
     @loader.load_doc()
     def test_pad(self, entries, _, ___):
         """
@@ -1071,5 +1153,193 @@ class TestLedgerConversion(test_utils.TestCase):
                 self.check_parses_ledger(lgrfile.name)
 
 
+class TestResidual(unittest.TestCase):
+    """
+    Test that skipping the residual computation doesn't change anything
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=".beancount", encoding="utf-8"
+        ) as beanfile:
+            example.write_example_file(
+                datetime.date(1980, 1, 1),
+                datetime.date(2010, 1, 1),
+                datetime.date(2014, 1, 1),
+                reformat=True,
+                file=beanfile,
+            )
+            beanfile.flush()
+            cls.entries, _, __ = loader.load_file(beanfile.name)
+
+    def test_fill_residual_posting(self):
+        skipped = 0
+        for entry in data.filter_txns(self.entries):
+            expected = interpolate.fill_residual_posting(entry, ROUNDING_ACCOUNT)
+            self.assertEqual(expected, fill_residual_posting(entry))
+            if not has_residual(entry):
+                skipped += 1
+        self.assertTrue(skipped)
+
+    def test_example(self):
+        for output_format in ("ledger", "hledger"):
+            expected = beancount2ledger.convert(self.entries, output_format)
+            with mock.patch(
+                "beancount2ledger.common.has_residual", return_value=True
+            ) as patched:
+                result = beancount2ledger.convert(self.entries, output_format)
+                self.assertTrue(patched.called)
+            self.assertEqual(expected, result)
+
+
+class TestDispatch(test_utils.TestCase):
+    """
+    Test rendering entries with registered handlers
+    """
+
+    @loader.load_doc()
+    def setUp(self, entries, _, __):
+        """
+        2014-01-01 open Assets:Cash
+
+        2014-02-15 price HOOL  500.00 USD
+
+        2015-01-01 custom "budget" Assets:Cash "yearly" 34.43 HRK
+        """
+        self.entries = entries
+
+    def test_register(self):
+        def custom(entry, out):
+            out.append(f";; Custom: {entry.date:%Y-%m-%d} {entry.type}\n")
+
+        for output_format in ("ledger", "hledger"):
+            printer = beancount2ledger.get_printer(
+                output_format, handlers={data.Custom: custom}
+            )
+            self.assertEqual(
+                ";; Custom: 2015-01-01 budget\n", printer(self.entries[-1])
+            )
+            self.assertEqual(
+                beancount2ledger.convert(self.entries[:2], output_format),
+                printer.render_all(self.entries[:2]),
+            )
+
+    def test_new_type(self):
+        Budget = collections.namedtuple("Budget", "meta date account")
+        printer = beancount2ledger.get_printer()
+        budget = Budget({}, datetime.date(2015, 1, 1), "Assets:Cash")
+        with self.assertRaises(AttributeError):
+            printer(budget)
+
+        printer.register(
+            Budget, lambda entry, out: out.append(f";; Budget: {entry.account}\n")
+        )
+        self.assertEqual(
+            "account Assets:Cash\n\n;; Budget: Assets:Cash\n",
+            printer.render_all([self.entries[0], budget]),
+        )
+
+        # Subclasses of printers find the methods named after new types
+        class BudgetPrinter(beancount2ledger.LedgerPrinter):
+            def Budget(self, entry, out):
+                out.append(";; Budget\n")
+
+        self.assertEqual(";; Budget\n", BudgetPrinter()(budget))
+
+    def test_convert(self):
+        def custom(entry, out):
+            out.append(f";; Custom: {entry.type}\n")
+
+        handlers = {data.Custom: custom}
+        expected = beancount2ledger.get_printer(handlers=handlers).render_all(
+            self.entries
+        )
+        self.assertIn(";; Custom: budget\n", expected)
+        self.assertEqual(
+            expected, beancount2ledger.convert(self.entries, handlers=handlers)
+        )
+        self.assertEqual(
+            expected,
+            "\n".join(beancount2ledger.convert_iter(self.entries, handlers=handlers)),
+        )
+        stream = io.StringIO()
+        beancount2ledger.convert_to(self.entries, stream, handlers=handlers)
+        self.assertEqual(expected, stream.getvalue())
+
+        # Worker processes inherit the handlers, which can't be pickled
+        with mock.patch("beancount2ledger.JOB_CHUNK_SIZE", 1):
+            result = beancount2ledger.convert(self.entries, jobs=2, handlers=handlers)
+        self.assertEqual(expected, result)
+
+        # Entries rendered by handlers aren't cached
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with RenderCache(f"{tmpdir}/cache.sqlite") as cache:
+                result = beancount2ledger.convert(
+                    self.entries, cache=cache, handlers=handlers
+                )
+                self.assertEqual(expected, result)
+                self.assertEqual({"hits": 0, "misses": 0, "evicted": 0}, cache.stats())
+
+
+class TestOptions(test_utils.TestCase):
+    """
+    Test compiling and checking the config
+    """
+
+    @loader.load_doc()
+    def test_indent(self, entries, _, __):
+        """
+        2020-01-01 open Assets:Test
+        2020-01-01 open Assets:Other
+
+        2020-11-13 * "Test"
+          note: "Test"
+          Assets:Test        1000.00 EUR
+            aux-date: 2020-11-14
+            note: "Posting"
+          Assets:Other
+        """
+        options = Options({"indent": 4, "auxdate": "aux-date"})
+        self.assertEqual("    ", options.posting_indent)
+        self.assertEqual("        ", options.meta_indent)
+        self.assertEqual(69, options.amount_width)
+        with self.assertRaises(AttributeError):
+            options.indent = 2
+
+        result = beancount2ledger.convert(entries, config=options.config)
+        self.assertLines(
+            """
+            account Assets:Test
+
+            account Assets:Other
+
+            2020-11-13 * Test
+                ; note: Test
+                Assets:Test                                               1000.00 EUR  ; [=2020-11-14]
+                    ; note: Posting
+                Assets:Other
+        """,  # NoQA: E501 line too long
+            result,
+        )
+
+    def test_invalid(self):
+        for config, message in (
+            ({"indnet": 4}, "Unknown config option 'indnet'"),
+            ({"indent": "4"}, "'indent' must be an integer, not '4'"),
+            ({"indent": True}, "'indent' must be an integer, not True"),
+            ({"indent": -1}, "'indent' must not be negative"),
+            ({"auxdate": 1}, "'auxdate' must be a string, not 1"),
+            ({"account_map": ["A"]}, "'account_map' must be a mapping"),
+            ({"currency_map": {"EUR": 1}}, "map names to names, not 'EUR' to 1"),
+            (["indent"], "expected a mapping of options"),
+        ):
+            with self.assertRaisesRegex(ValueError, re.escape(message)):
+                beancount2ledger.convert([], config=config)
+
+        # Options can be left empty in a YAML file
+        Options({"auxdate": None, "account_map": None})
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -13,7 +13,7 @@ from beancount.parser import cmptest
 from beancount import loader
 
 import beancount2ledger
-from beancount2ledger.common import map_data
+from beancount2ledger.common import Mapper
 
 
 class TestMappingUtilityFunctions(cmptest.TestCase):
@@ -36,10 +36,11 @@ class TestMappingUtilityFunctions(cmptest.TestCase):
             "Assets:Test-Bank": "Assets:Test Bank",
             "Assets:Testx": "Assets:Testx",
             "Assets:ABC": "Assets:ABC",
-            "Assets:Test  Assets:Test": "Assets:My Test  Assets:My Test",
         }
+        mapper = Mapper.from_config(config)
         for orig, expected in test.items():
-            self.assertEqual(map_data(orig, config), expected)
+            self.assertEqual(mapper.account_name(orig), expected)
+        self.assertEqual(2, mapper.substitutions)
 
     def test_currency(self):
         """
@@ -55,14 +56,18 @@ class TestMappingUtilityFunctions(cmptest.TestCase):
             "TEST": "TEST1",
         }
         test = {
-            "0 EUR": "0 €",
-            "0 EUR1": '0 "EUR123"',
-            "0 EUR2": "0 EUR",
-            "0 EURO": "0 EUR",
-            "0 TEST": '0 "TEST1"',
+            "EUR": "€",
+            "EUR1": '"EUR123"',
+            "EUR2": "EUR",
+            "EURO": "EUR",
+            "TEST": '"TEST1"',
+            "USD": "USD",
         }
+        mapper = Mapper.from_config(config)
         for orig, expected in test.items():
-            self.assertEqual(map_data(orig, config), expected)
+            self.assertEqual(mapper.quoted_currency(orig), expected)
+            self.assertEqual(mapper.currency_name(orig), expected.strip('"'))
+        self.assertFalse(Mapper.from_config({}))
 
 
 class TestMappingConversion(test_utils.TestCase):
@@ -108,3 +113,86 @@ class TestMappingConversion(test_utils.TestCase):
         """,  # NoQA: E501 line too long
             result,
         )
+
+    @loader.load_doc()
+    def test_directives(self, entries, _, __):
+        """
+        2020-01-01 commodity TEST
+
+        2020-01-01 open Assets:Test  EUR,TEST
+        2020-01-01 open Assets:Test-Bank
+
+        2020-01-02 price TEST 2.00 EUR
+
+        2020-01-03 note Assets:Test "Test note"
+
+        2020-11-13 * "Test 1000.00 EUR"
+          Assets:Test        1000.00 EUR
+          Assets:Test-Bank
+          Assets:Test        -1 TEST {1.00 EUR}
+          Assets:Test-Bank   1 TEST @ 1.00 EUR
+          amount: 1.00 TEST
+
+        2020-12-31 close Assets:Test-Bank
+        """
+        result = beancount2ledger.convert(entries, config=self.config)
+        self.assertLines(
+            """
+            account Assets:My Test
+              assert commodity == "€" | commodity == "TEST1"
+
+            account Assets:Test Bank
+
+            commodity TEST1
+
+            P 2020-01-02 "TEST1"                                        2.00 €
+
+            ;; Note: 2020-01-03 Assets:My Test Test note
+
+            2020-11-13 * Test 1000.00 EUR
+                Assets:My Test                                                 1000.00 €
+                Assets:Test Bank
+                Assets:My Test                                        -1 "TEST1" {1.00 €}
+                Assets:Test Bank                                     1 "TEST1" @ 1.00 €
+                  ; amount:: 1.00 TEST1
+
+            ;; Close: 2020-12-31 close Assets:Test Bank
+        """,  # NoQA: E501 line too long
+            result,
+        )
+
+    @loader.load_doc()
+    def test_quoting(self, entries, _, __):
+        """
+        2020-01-01 commodity V2X
+        2020-01-01 open Assets:Test
+
+        2020-01-02 price V2X 3.00 E-1
+
+        2020-11-13 * "Test"
+          amount: 5.00 V2X
+          Assets:Test        10 V2X {2.00 E-1} @ 3.00 E-1
+          Assets:Test
+        """
+        # Only the amounts of postings are quoted, like in earlier versions
+        tests = (
+            ("ledger", "::", '{2.00 "E-1"} @ 3.00 "E-1"'),
+            ("hledger", ":", '@ 2.00 "E-1"'),
+        )
+        for output_format, sep, price in tests:
+            result = beancount2ledger.convert(entries, output_format)
+            self.assertLines(
+                f"""
+                account Assets:Test
+
+                commodity V2X
+
+                P 2020-01-02 "V2X"                                                 3.00 E-1
+
+                2020-11-13 * Test
+                    ; amount{sep} 5.00 V2X
+                    Assets:Test    10 "V2X" {price}
+                    Assets:Test
+            """,  # NoQA: E501 line too long
+                result,
+            )
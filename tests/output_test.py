@@ -0,0 +1,69 @@
+"""
+Tests for writing output files
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import os
+import stat
+import tempfile
+import unittest
+
+from beancount2ledger.output import atomic_open
+
+
+class TestAtomicOpen(unittest.TestCase):
+    """
+    Test replacing output files atomically
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+        self.path = os.path.join(self.dir, "output.ledger")
+
+    def read(self):
+        """
+        Return the content of the output file
+        """
+
+        with open(self.path, encoding="utf-8") as stream:
+            return stream.read()
+
+    def test_replace(self):
+        """
+        Test that the output only appears when it's complete
+        """
+
+        with open(self.path, "w") as stream:
+            stream.write("old\n")
+        os.chmod(self.path, 0o640)
+        with atomic_open(self.path) as stream:
+            stream.write("new €\n")
+            self.assertEqual("old\n", self.read())
+        self.assertEqual("new €\n", self.read())
+        self.assertEqual(0o640, stat.S_IMODE(os.stat(self.path).st_mode))
+        self.assertEqual(["output.ledger"], os.listdir(self.dir))
+
+    def test_error(self):
+        """
+        Test that the output is left untouched if writing fails
+        """
+
+        with open(self.path, "w") as stream:
+            stream.write("old\n")
+        with self.assertRaises(RuntimeError):
+            with atomic_open(self.path) as stream:
+                stream.write("new\n")
+                raise RuntimeError("conversion failed")
+        self.assertEqual("old\n", self.read())
+        self.assertEqual(["output.ledger"], os.listdir(self.dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
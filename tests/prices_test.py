@@ -0,0 +1,97 @@
+"""
+Tests for the export of prices
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import io
+import unittest
+from unittest import mock
+
+from beancount.utils import test_utils
+from beancount import loader
+
+import beancount2ledger
+from beancount2ledger import prices
+
+
+class TestPrices(test_utils.TestCase):
+    """
+    Test exporting prices as a compact price database
+    """
+
+    @loader.load_doc()
+    def setUp(self, entries, _, __):
+        """
+        2020-01-01 open Assets:Test
+
+        2020-01-02 price HOOL 500.00 EUR
+        2020-01-02 price HOOL 500.0 EUR
+        2020-01-02 price ABC 100 EUR
+        2020-01-02 price ABC 0.10 V2X
+
+        2020-01-03 price HOOL 500.00 EUR
+        2020-01-03 price HOOL 0.000001 USD
+
+        2020-11-13 * "Test"
+          Assets:Test        1000.00 EUR
+          Assets:Test
+        """
+        self.entries = entries
+
+    def test_convert_prices(self):
+        """
+        Test that prices are like the ones of a full conversion
+        """
+
+        result = prices.convert_prices(self.entries)
+        self.assertEqual(
+            "P 2020-01-02 HOOL 500.00 EUR\n"
+            "P 2020-01-02 HOOL 500.0 EUR\n"
+            "P 2020-01-02 ABC 100 EUR\n"
+            "P 2020-01-02 ABC 0.10 V2X\n"
+            "P 2020-01-03 HOOL 500.00 EUR\n"
+            "P 2020-01-03 HOOL 0.000001 USD\n",
+            result,
+        )
+        full = beancount2ledger.convert(self.entries)
+        self.assertEqual(
+            [line.split() for line in full.splitlines() if line.startswith("P ")],
+            [line.split() for line in result.splitlines()],
+        )
+
+    def test_dedupe(self):
+        """
+        Test skipping prices with the same date, commodity and amount
+        """
+
+        result = prices.convert_prices(self.entries, dedupe=True)
+        self.assertEqual(
+            "P 2020-01-02 HOOL 500.00 EUR\n"
+            "P 2020-01-02 ABC 100 EUR\n"
+            "P 2020-01-02 ABC 0.10 V2X\n"
+            "P 2020-01-03 HOOL 500.00 EUR\n"
+            "P 2020-01-03 HOOL 0.000001 USD\n",
+            result,
+        )
+
+    def test_convert_prices_to(self):
+        """
+        Test writing prices in chunks with mapped currencies
+        """
+
+        config = {"currency_map": {"HOOL": "HOOL2"}}
+        stream = io.StringIO()
+        with mock.patch("beancount2ledger.prices.CHUNK_SIZE", 2):
+            count = prices.convert_prices_to(self.entries, stream, config)
+        self.assertEqual(6, count)
+        self.assertEqual(prices.convert_prices(self.entries, config), stream.getvalue())
+        self.assertIn('P 2020-01-03 "HOOL2" 500.00 EUR\n', stream.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
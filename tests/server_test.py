@@ -0,0 +1,120 @@
+"""
+Tests for the conversion server
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import datetime
+import io
+import os
+import tempfile
+import textwrap
+import threading
+import unittest
+
+from beancount2ledger import server
+
+
+class TestServer(unittest.TestCase):
+    """
+    Test answering conversion requests on a socket
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.file = os.path.join(tmpdir.name, "main.beancount")
+        self.include = os.path.join(tmpdir.name, "accounts.beancount")
+        self.socket = os.path.join(tmpdir.name, "server.sock")
+        self.write(self.file, 'include "accounts.beancount"\n')
+        self.write(self.include, "2020-01-01 open Assets:Test\n")
+
+        self.server = server.Server(self.socket, server.Books(self.file))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def write(self, file, text):
+        """
+        Write text to file, making sure its modification time changes
+        """
+
+        stat = os.stat(file) if os.path.exists(file) else None
+        with open(file, "w") as stream:
+            stream.write(text)
+        if stat:
+            os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    def request(self, **params):
+        """
+        Send a request and return the output
+        """
+
+        stream = io.BytesIO()
+        server.request(stream, self.socket, **params)
+        return stream.getvalue().decode("utf-8")
+
+    def test_request(self):
+        """
+        Test conversion, config overrides and reloading changed includes
+        """
+
+        self.assertEqual("account Assets:Test\n\n", self.request())
+        config = {"account_map": {"Assets:Test": "Assets:Mapped"}}
+        self.assertEqual(
+            "account Assets:Mapped\n\n", self.request(format="hledger", config=config)
+        )
+
+        self.write(
+            self.include,
+            textwrap.dedent(
+                """
+                2020-01-01 open Assets:Test
+                2020-01-01 open Assets:Other
+                """
+            ),
+        )
+        self.assertEqual(
+            "account Assets:Test\n\naccount Assets:Other\n\n", self.request()
+        )
+        self.assertEqual(2, self.server.books.generation)
+
+    def test_errors(self):
+        """
+        Test that invalid requests are answered with an error
+        """
+
+        with self.assertRaisesRegex(ValueError, "unknown format"):
+            self.request(format="csv")
+        with self.assertRaisesRegex(ValueError, "unknown keys"):
+            self.request(output="-")
+        with self.assertRaisesRegex(ValueError, "Invalid date"):
+            self.request(begin="yesterday")
+        with self.assertRaisesRegex(ValueError, "begin must be a string or null"):
+            self.request(begin=20200101)
+        with self.assertRaisesRegex(ValueError, "opening must be a boolean"):
+            self.request(opening="yes")
+        with self.assertRaisesRegex(ValueError, "'indent' must be an integer"):
+            self.request(config={"indent": "4"})
+
+        # Values which can't be sent, such as dates in a YAML config
+        with self.assertRaisesRegex(ValueError, "not JSON serializable"):
+            self.request(config={"auxdate": datetime.date(2020, 1, 1)})
+
+    def test_running(self):
+        """
+        Test that a second server doesn't take over the socket
+        """
+
+        with self.assertRaises(RuntimeError):
+            server.Server(self.socket, self.server.books)
+
+
+if __name__ == "__main__":
+    unittest.main()
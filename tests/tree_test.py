@@ -0,0 +1,198 @@
+"""
+Tests for converting books to one output file per source file
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import os
+from pathlib import Path
+import tempfile
+import textwrap
+import time
+import unittest
+
+from beancount2ledger.tree import convert_tree
+
+
+class TestConvertTree(unittest.TestCase):
+    """
+    Test mirroring the include tree
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.source = Path(tmpdir.name) / "books"
+        self.output = Path(tmpdir.name) / "output"
+        self.write(
+            "main.beancount",
+            """
+            include "accounts.beancount"
+            include "2020/*.beancount"
+
+            2020-01-01 open Expenses:Food
+            """,
+        )
+        self.write(
+            "accounts.beancount",
+            """
+            2020-01-01 open Assets:Cash
+            """,
+        )
+        self.write(
+            "2020/01.beancount",
+            """
+            2020-01-13 * "Lunch"
+              Expenses:Food        10.00 EUR
+              Assets:Cash
+            """,
+        )
+
+    def write(self, name, text, age=60):
+        """
+        Write a source file last modified age seconds ago
+        """
+
+        path = self.source / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(textwrap.dedent(text))
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+
+    def read(self, name):
+        """
+        Read an output file
+        """
+
+        return (self.output / name).read_text()
+
+    def test_tree(self):
+        """
+        Test the outputs and that only changed outputs are written
+        """
+
+        written, outputs = convert_tree(self.source / "main.beancount", self.output)
+        expected = [
+            Path("2020/01.ledger"),
+            Path("accounts.ledger"),
+            Path("main.ledger"),
+        ]
+        self.assertEqual(expected, outputs)
+        self.assertEqual(expected, sorted(written))
+        self.assertEqual(
+            "include accounts.ledger\n"
+            "include 2020/01.ledger\n"
+            "\n"
+            "account Expenses:Food\n"
+            "\n",
+            self.read("main.ledger"),
+        )
+        self.assertEqual("account Assets:Cash\n\n", self.read("accounts.ledger"))
+        self.assertIn("Lunch", self.read("2020/01.ledger"))
+
+        written, _ = convert_tree(self.source / "main.beancount", self.output)
+        self.assertEqual([], written)
+
+        self.write(
+            "accounts.beancount",
+            """
+            2020-01-01 open Assets:Cash
+            2020-01-01 open Assets:Bank
+            """,
+        )
+        written, _ = convert_tree(self.source / "main.beancount", self.output)
+        self.assertEqual([Path("accounts.ledger")], written)
+
+        # Files modified just before the conversion may have changed
+        # after they were loaded
+        self.write("accounts.beancount", "2020-01-01 open Assets:Cash\n", 0)
+        written, _ = convert_tree(self.source / "main.beancount", self.output)
+        self.assertEqual([Path("accounts.ledger")], written)
+        written, _ = convert_tree(self.source / "main.beancount", self.output)
+        self.assertEqual([Path("accounts.ledger")], written)
+        os.utime(self.source / "accounts.beancount", (0, 0))
+        written, _ = convert_tree(self.source / "main.beancount", self.output)
+        self.assertEqual([Path("accounts.ledger")], written)
+
+        # Outputs which were removed are written again
+        os.unlink(self.output / "2020" / "01.ledger")
+        written, _ = convert_tree(self.source / "main.beancount", self.output)
+        self.assertEqual([Path("2020/01.ledger")], written)
+
+    def test_removed(self):
+        """
+        Test that outputs of files which are no longer included are removed
+        """
+
+        self.write(
+            "2020/02.beancount",
+            """
+            2020-02-01 open Assets:Bank
+            """,
+        )
+        convert_tree(self.source / "main.beancount", self.output, "hledger")
+        self.assertTrue((self.output / "2020" / "02.journal").exists())
+        os.unlink(self.source / "2020" / "02.beancount")
+        written, outputs = convert_tree(
+            self.source / "main.beancount", self.output, "hledger"
+        )
+        self.assertEqual([Path("main.journal")], written)
+        self.assertEqual(
+            [Path("2020/01.journal"), Path("accounts.journal"), Path("main.journal")],
+            outputs,
+        )
+        self.assertFalse((self.output / "2020" / "02.journal").exists())
+
+    def test_padding(self):
+        """
+        Test that padding is written with explicit amounts, since ledger
+        reads the outputs in the order of the includes
+        """
+
+        self.write(
+            "2020/02.beancount",
+            """
+            2020-02-01 pad Assets:Cash Expenses:Food
+            2020-02-02 balance Assets:Cash -20.00 EUR
+            """,
+        )
+        convert_tree(self.source / "main.beancount", self.output)
+        output = self.read("2020/02.ledger")
+        self.assertNotIn("=", output)
+        postings = [line.split() for line in output.splitlines() if line[:1] == " "]
+        self.assertEqual(
+            [["Assets:Cash", "-10.00", "EUR"], ["Expenses:Food", "10.00", "EUR"]],
+            postings,
+        )
+
+        # The amount depends on the entries of other files
+        self.write(
+            "2020/01.beancount",
+            """
+            2020-01-13 * "Lunch"
+              Expenses:Food        15.00 EUR
+              Assets:Cash
+            """,
+        )
+        written, _ = convert_tree(self.source / "main.beancount", self.output)
+        self.assertEqual([Path("2020/01.ledger"), Path("2020/02.ledger")], written)
+        self.assertIn("-5.00 EUR", self.read("2020/02.ledger"))
+
+    def test_collision(self):
+        """
+        Test that sources which would have the same output are reported
+        """
+
+        self.write("2020/01.bean", "")
+        self.write("main.beancount", 'include "2020/*"\n')
+        with self.assertRaisesRegex(ValueError, "would both be converted to"):
+            convert_tree(self.source / "main.beancount", self.output)
+        self.assertFalse(self.output.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+"""
+Tests for converting books again when they change
+"""
+
+# SPDX-FileCopyrightText: © 2020 Software in the Public Interest, Inc.
+
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+__license__ = "GPL-2.0-or-later"
+
+import io
+import os
+import tempfile
+import textwrap
+import threading
+import unittest
+from unittest import mock
+
+import beancount2ledger
+from beancount2ledger import watch
+from beancount2ledger.server import Books
+
+
+class TestWaitForChange(unittest.TestCase):
+    """
+    Test noticing changes to included files
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.file = os.path.join(tmpdir.name, "main.beancount")
+        self.include = os.path.join(tmpdir.name, "accounts.beancount")
+        with open(self.file, "w") as stream:
+            stream.write('include "accounts.beancount"\n')
+        with open(self.include, "w") as stream:
+            stream.write("2020-01-01 open Assets:Test\n")
+        self.books = Books(self.file)
+
+    def change(self):
+        """
+        Replace the included file like an editor would, after the watch
+        started
+        """
+
+        def replace():
+            new = self.include + ".new"
+            with open(new, "w") as stream:
+                stream.write("2020-01-01 open Assets:Other\n")
+            os.replace(new, self.include)
+
+        timer = threading.Timer(0.2, replace)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def check(self, libc):
+        """
+        Test that a change is noticed and reloads the books
+        """
+
+        self.change()
+        with mock.patch("beancount2ledger.watch.SETTLE_TIME", 0):
+            watch.wait_for_change(self.books, 0.01, libc)
+        self.assertTrue(self.books.changed())
+        _, entries, __ = self.books.refresh()
+        self.assertEqual("Assets:Other", entries[0].account)
+
+    def test_polling(self):
+        """
+        Test polling for changes
+        """
+
+        self.check(None)
+
+    @unittest.skipUnless(watch.load_libc(), "inotify not available")
+    def test_inotify(self):
+        """
+        Test waiting for changes with inotify
+        """
+
+        self.check(watch.load_libc())
+
+
+class TestIncrementalCache(unittest.TestCase):
+    """
+    Test rendering only the entries which changed since the last
+    conversion
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.file = os.path.join(tmpdir.name, "main.beancount")
+        self.include = os.path.join(tmpdir.name, "sales.beancount")
+        self.write(
+            self.file,
+            """
+            include "sales.beancount"
+
+            2020-01-01 open Assets:Test
+            2020-01-01 open Assets:Other
+
+            2020-11-13 * "Buy"
+              Assets:Test        1 HOOL {100.0 EUR}
+              Assets:Other      -100.00 EUR
+              Assets:Other         0.00 EUR
+            """,
+        )
+        self.write(
+            self.include,
+            """
+            2020-11-14 * "Sell"
+              Assets:Test        -1 HOOL {}
+              Assets:Other
+
+            2020-11-15 * "Move"
+              Assets:Test         1.00 EUR
+              Assets:Other
+            """,
+        )
+        self.books = Books(self.file)
+        self.cache = watch.IncrementalCache(self.books)
+
+    def write(self, file, text, mtime=0):
+        """
+        Write text to file with the given modification time
+        """
+
+        with open(file, "w") as stream:
+            stream.write(textwrap.dedent(text))
+        os.utime(file, (mtime, mtime))
+
+    def convert(self):
+        """
+        Reload the books if they changed, convert them with the cache
+        and check that the output is like the one without cache
+        """
+
+        _, entries, dcontext = self.books.refresh()
+        stream = io.StringIO()
+        beancount2ledger.convert_to(
+            entries, stream, dcontext=dcontext, cache=self.cache
+        )
+        self.assertEqual(
+            beancount2ledger.convert(entries, dcontext=dcontext), stream.getvalue()
+        )
+        return stream.getvalue()
+
+    def test_incremental(self):
+        """
+        Test that entries are rendered again if they or their file
+        changed
+        """
+
+        self.convert()
+        self.assertEqual({"hits": 0, "misses": 5, "evicted": 0}, self.cache.stats())
+        self.convert()
+        self.assertEqual({"hits": 5, "misses": 5, "evicted": 0}, self.cache.stats())
+
+        # The cost of the sale is booked from the changed file
+        with open(self.file) as stream:
+            text = stream.read().replace("{100.0 EUR}", "{100.00 EUR}")
+        self.write(self.file, text, 1)
+        self.assertIn("-1 HOOL {100.00 EUR}", self.convert())
+        self.assertEqual({"hits": 6, "misses": 9, "evicted": 3}, self.cache.stats())
+
+
+if __name__ == "__main__":
+    unittest.main()